@@ -9,13 +9,6 @@ from kernel.settings import DEBUG, DEBUG_SIMULATION, DEBUG_ORM, DEBUG_ROUTE_SEAR
 from kernel.utils import Mock
 
 
-try:
-    import line_profiler  # noqa
-except ImportError:
-    profiler = Mock()
-else:
-    profiler = line_profiler.LineProfiler()
-
 try:
     import renpy
 except ImportError:
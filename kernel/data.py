@@ -6,10 +6,18 @@ import os
 import kernel.models as models
 
 from kernel import BASE_DIR
+from kernel.settings import STORAGE_ENGINE, STORAGE_SQLITE_PATH, STORAGE_SQLITE_CACHE_ROWS
 
 db = {}
 classes = {}
 
+if STORAGE_ENGINE == 'sqlite':
+    from kernel.storage import SqliteTable, get_connection
+
+    connection = get_connection(STORAGE_SQLITE_PATH or os.path.join(BASE_DIR, 'simulation.sqlite3'))
+elif STORAGE_ENGINE != 'memory':
+    raise ValueError('Storage engine "{}" not found'.format(STORAGE_ENGINE))
+
 db_path = os.path.join(BASE_DIR, 'kernel', 'db')
 for path_ in os.listdir(db_path):
     if path_ == '.empty':
@@ -32,6 +40,8 @@ for path_ in os.listdir(db_path):
         if not isinstance(k, int) and k.isdigit():
             data['objects'][int(k)] = data['objects'].pop(k)
 
+    if STORAGE_ENGINE == 'sqlite':  # the rows of the file are dropped before the next one is read
+        data['objects'] = SqliteTable(connection, data, STORAGE_SQLITE_CACHE_ROWS)
     db[model_name] = data
     klass = getattr(models, model_name, None)
     if klass:
@@ -60,3 +70,11 @@ for model_name, klass in classes.items():
 
     for set_data in klass.set_data.values():
         set_data['model'] = classes[set_data['model']]
+
+plan_data_class = classes['PlanData']  # stages are kept as indexes of the compiled plan stages, the dump has names
+if 'plan_stage' in plan_data_class.defaults:
+    plan_data_class.defaults['plan_stage'] = models.Plan.get_stage_index(plan_data_class.defaults['plan_stage'])
+for pk_, row_ in list(plan_data_class.db_objects.items()):
+    if row_['plan_stage'] in models.Plan.stages_names:
+        row_['plan_stage'] = models.Plan.get_stage_index(row_['plan_stage'])
+        plan_data_class.db_objects[pk_] = row_
@@ -1,23 +1,32 @@
 from __future__ import division
 from builtins import object
 
+import itertools
 import logging
-import re
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, namedtuple, OrderedDict
 from math import ceil
 from kernel.orm import QuerySet
+from kernel.profiler import phase
 from kernel.settings import DEBUG_ROUTE_SEARCH, DEBUG_SET_POSITIONS, DEBUG_SIMULATION, PLAYER_ID
 from kernel.simulation.plans.modifiers import PlanModifiersPosNeg, CharacterPlanModifiers
 from kernel.utils import (
-    get_value_replaced,
+    dirty_rows,
+    fields_versions,
+    fixed_multiply,
+    from_fixed,
     get_value_replaced_second_char,
     get_filters_replaced,
+    get_compiled_text,
+    get_compiled_text_replaced,
+    get_text_replaced,
     plan_pauses,
     qs_cache,
     qs_cache_relations,
     player_data,
+    random_streams,
     relations_cache,
+    to_fixed,
     unicode
 )
 
@@ -26,6 +35,11 @@ from kernel import renpy
 logger_simulation = logging.getLogger('simulation')
 logger_positions = logging.getLogger('positions')
 
+STAGE_KIND_NONE, STAGE_KIND_EFFECTS, STAGE_KIND_ROUTE, STAGE_KIND_LOCK, STAGE_KIND_PAUSE = range(5)
+StageRecord = namedtuple('StageRecord', (
+    'stage', 'kind', 'next_index', 'is_filter_stage', 'is_plan_set', 'is_time_filters', 'is_finished_in_time'
+))
+
 
 class BaseModel(object):
     objects = None
@@ -34,6 +48,8 @@ class BaseModel(object):
     db_objects_row = None
     mtm_data = None
     set_data = None
+    pk_step = 1
+    pk_offset = 0
     __is_initialized = False
     __instances = {}
 
@@ -118,6 +134,52 @@ class BaseModel(object):
     def get_new_queryset(cls, base_filters=None):
         return QuerySet(cls, base_filters)
 
+    @classmethod
+    def set_dirty(cls, pk, fields=None):
+        """Mark row as changed since the last save, fields=None means the whole row(created or deleted)"""
+        model_dirty = dirty_rows[cls.__name__]
+        if fields is None:
+            model_dirty[pk] = None
+        elif pk not in model_dirty:
+            model_dirty[pk] = set(fields)
+        elif model_dirty[pk] is not None:
+            model_dirty[pk].update(fields)
+
+    @classmethod
+    def set_changed(cls, pk=None, fields=()):
+        """Bumps versions of the changed fields, of the row and of the table, caches keyed by them become outdated"""
+        cls_name = cls.__name__
+        fields_versions[cls_name] += 1
+        if fields:
+            fields_versions[(cls_name, pk)] += 1
+        for field in fields:
+            fields_versions[(cls_name, pk, field)] += 1
+
+    @classmethod
+    def swap_instances(cls, instances):
+        instances_old = BaseModel.__instances
+        BaseModel.__instances = instances
+        return instances_old
+
+    @classmethod
+    def refresh_instances(cls):
+        """Sync cached instances with the rows after the tables were replaced"""
+        for key, instance in list(cls.__instances.items()):
+            klass = instance.__class__
+            pk = key[1]
+            if pk not in klass.db_objects:
+                del cls.__instances[key]
+                instance.id = instance.pk = None  # noqa
+                continue
+            if not instance.__is_initialized:
+                instance.__init__(pk)
+                continue
+            instance.db_objects_row = klass.db_objects[pk]
+            for name in instance.db_objects_row:
+                setattr(instance, name, instance.db_objects_row[name])
+            for name in itertools.chain(klass.mto_data, klass.set_data, klass.mtm_data):
+                instance.__dict__.pop(name, None)
+
     @classmethod
     def clean_qs_cache(cls):
         cls_name = cls.__name__
@@ -127,6 +189,11 @@ class BaseModel(object):
             del qs_cache[qs_cache_key]
         del qs_cache_relations[cls_name]
 
+    def get_row_writable(self):
+        if self.db_objects.__class__ is not dict:  # fork or storage engine table
+            self.db_objects_row = self.db_objects.get_writable(self.pk)
+        return self.db_objects_row
+
     def clone(self, **kwargs):
         data = self.db_objects_row.copy()
         del data['id']
@@ -142,6 +209,8 @@ class BaseModel(object):
             set_id = kwargs['id']
         else:
             set_id = max(cls.db_objects) + 1 if cls.db_objects else 1
+            if cls.pk_step > 1:  # processes of the sharded simulation create rows with not overlapping pks
+                set_id += (cls.pk_offset - set_id) % cls.pk_step
             data['id'] = set_id
 
         for k in cls.objects_fields:
@@ -170,6 +239,8 @@ class BaseModel(object):
                 instance_ids[k] = v
 
         cls.db_objects[set_id] = data
+        cls.set_dirty(set_id)
+        cls.set_changed()
         instance = cls(set_id)
         for k in instance_ids:
             setattr(instance, k, instance_ids[k])
@@ -181,6 +252,9 @@ class BaseModel(object):
         if not kwargs:
             return
 
+        row = self.get_row_writable()
+        row_keys = []
+        changed_keys = []
         for key in kwargs:
             value = kwargs[key]
 
@@ -195,7 +269,10 @@ class BaseModel(object):
                 mto_key = self.mto_data[key]['from_id']
                 mto_value = value.id if value else None
                 setattr(self, mto_key, mto_value)
-                self.db_objects_row[mto_key] = mto_value
+                if row.get(mto_key) != mto_value:
+                    changed_keys.append(mto_key)
+                row[mto_key] = mto_value
+                row_keys.append(mto_key)
             elif key.endswith('_id'):
                 mto_key = key[:-3]
                 setattr(self, mto_key, self.mto_data.get(mto_key)['model'](value) if value else None)
@@ -204,8 +281,16 @@ class BaseModel(object):
 
             setattr(self, key, value)
             if key in self.objects_fields:
-                self.db_objects_row[key] = value
-
+                if row.get(key) != value:
+                    changed_keys.append(key)
+                row[key] = value
+                row_keys.append(key)
+
+        if self.db_objects.__class__ is not dict:
+            self.db_objects[self.pk] = row
+        self.set_dirty(self.pk, row_keys)
+        if changed_keys:
+            self.set_changed(self.pk, changed_keys)
         self.clean_qs_cache()
 
     def delete(self):
@@ -218,18 +303,77 @@ class BaseModel(object):
                 instance.update(**{rel_target_id: None})
 
         del self.db_objects[self.pk]
+        self.set_dirty(self.pk)
+        self.set_changed()
         del self.__instances[(self.__class__.__name__, self.pk)]
+        random_streams.pop((self.__class__.__name__, self.pk), None)  # the pk can be reused
         self.clean_qs_cache()
         self.id = self.pk = None # noqa
 
 
 # Characters
 class Plan(BaseModel):
-    stages_next = {None: 'one', 'one': 'two', 'two': 'three', 'three': 'four', 'four': 'five', 'five': None}
+    stages_names = ('one', 'two', 'three', 'four', 'five')
 
     def __str__(self):
         return self.title
 
+    @classmethod
+    def get_stage_index(cls, plan_stage):
+        """Index of the stage name of the dump, indexes are returned as they are"""
+        if plan_stage in cls.stages_names:
+            return cls.stages_names.index(plan_stage)
+        return plan_stage
+
+    @staticmethod
+    def compile_stage(stage, next_index):
+        if stage is None:
+            return StageRecord(None, STAGE_KIND_NONE, next_index, False, False, False, True)
+        filters = stage.filters
+        is_time_filters = bool(filters and filters.time_max_seconds)
+        if stage.effects_id:
+            kind = STAGE_KIND_EFFECTS
+        elif stage.filters_place_id and not is_time_filters:
+            kind = STAGE_KIND_ROUTE
+        elif stage.lock_id and not is_time_filters:
+            kind = STAGE_KIND_LOCK
+        elif stage.plan_pause_id and not is_time_filters:
+            kind = STAGE_KIND_PAUSE
+        else:
+            kind = STAGE_KIND_NONE
+        if stage.effects_id:
+            is_finished_in_time = bool(stage.filters_id)
+        elif stage.filters_plan_set_id or stage.lock_id or stage.plan_pause_id:
+            is_finished_in_time = False
+        else:
+            is_finished_in_time = not (
+                stage.is_filter_stage and not (filters and (filters.time_min_seconds or filters.time_max_seconds))
+            )
+        return StageRecord(
+            stage, kind, next_index, bool(stage.is_filter_stage), bool(stage.filters_plan_set_id), is_time_filters,
+            is_finished_in_time
+        )
+
+    def get_stages(self):
+        """
+        Stages compiled into records(kind of the stage, index of the next one, flags), PlanData.plan_stage is
+        the index, cached until plans or stages are changed
+        """
+        qs_cache_key = ('PlanStages', self.id)
+        cached = qs_cache.get(qs_cache_key)
+        if cached is not None:
+            return cached['queryset']
+        stages = [getattr(self, name) for name in self.stages_names]
+        records = tuple(
+            self.compile_stage(stage, inx + 1 if inx + 1 < len(stages) and stages[inx + 1] else None)
+            for inx, stage in enumerate(stages)
+        )
+        relations = ['Plan', 'Stage', 'PlanFilters']
+        qs_cache[qs_cache_key] = {'queryset': records, 'relations': relations}
+        for model_name in relations:
+            qs_cache_relations[model_name].append(qs_cache_key)
+        return records
+
     def set_pause(
             self,
             char_id,
@@ -257,19 +401,18 @@ class Plan(BaseModel):
             pause_seconds = 1
         else:
             return False
-        plan_pauses[char_id][self.id] = -1 if pause_seconds == -1 else current_seconds + pause_seconds
+        seconds_until = -1 if pause_seconds == -1 else current_seconds + pause_seconds
+        plan_pauses.set(char_id, self.id, seconds_until)
         if DEBUG_SIMULATION:
             logger_simulation.info('set pause for {}({}) until {}'.format(
-                self.title, Character(char_id).title, plan_pauses[char_id][self.id]
+                self.title, Character(char_id).title, seconds_until
             ))
 
         return True
 
     @staticmethod
     def get_replaced_text(text, instance):
-        return text.format(**{
-            name: get_value_replaced(instance, name) for name in re.findall(r'{(.*?)}', text)
-        })
+        return get_text_replaced(text, instance)
 
     def get_event_description(self, instance):
         return self.get_replaced_text(self.event_desc, instance)
@@ -306,16 +449,34 @@ class EventLog(BaseModel):
     def get_description(self):
         return self.plan.get_event_description(self)
 
+    @staticmethod
+    def get_descriptions(logs):
+        """Descriptions of the log rows for the history screens, the template of every plan is compiled once"""
+        templates = {}
+        descriptions = []
+        for log in logs:
+            template = templates.get(log.plan_id)
+            if template is None:
+                text = log.plan.event_desc
+                template = templates[log.plan_id] = (text, get_compiled_text(text))
+            descriptions.append(get_compiled_text_replaced(template[0], template[1], log))
+        return descriptions
+
 
 class PlanData(BaseModel):
     def __str__(self):
-        items = ['{}({}): {}'.format(self.plan.title, self.plan_stage, self.first_character.title)]
+        items = ['{}({}): {}'.format(
+            self.plan.title, Plan.stages_names[self.plan_stage], self.first_character.title
+        )]
         if self.second_character_id:
             items.append(' and {}'.format(self.second_character.title))
         return ''.join(items)
 
+    def get_stage_record(self):
+        return self.plan.get_stages()[self.plan_stage]
+
     def get_stage(self):
-        return getattr(self.plan, self.plan_stage)
+        return self.get_stage_record().stage
 
     def set_pause(self, char_id, current_seconds, is_interrupted=False, pause_seconds=None):
         stage = self.get_stage()
@@ -329,10 +490,10 @@ class PlanData(BaseModel):
             self.finish_plan(current_seconds)
 
     def next_stage(self):
-        next_stage = self.plan.stages_next[self.plan_stage]
-        if not getattr(self.plan, next_stage):
+        next_index = self.get_stage_record().next_index
+        if next_index is None:
             return False
-        self.update(plan_stage=next_stage)
+        self.update(plan_stage=next_index)
         return True
 
     def finish_plan(self, current_seconds, is_interrupted=False, pause_seconds=None):
@@ -605,7 +766,7 @@ class PlanEffectsSet(BaseModel):
             else:
                 mod = 1
 
-            effects_item = {k: v * 1000 * mod / 1000 for k, v in data.effects.items()} if mod != 1 else data.effects
+            effects_item = {k: fixed_multiply(v, mod) for k, v in data.effects.items()} if mod != 1 else data.effects
             for name in effects_item:
                 if name in effects:
                     effects[name] += effects_item[name]
@@ -626,6 +787,7 @@ class PlanEffects(BaseModel):
 
 
 class PlanFilters(BaseModel):
+    @phase('filters')
     def filter(self, first_character, second_character=None):
         for char_own, char_other, filters_data in (
             (first_character, second_character, self.first_character),
@@ -879,9 +1041,9 @@ class Route(BaseModel):
         route_distance = 0
         places = OrderedDict({0: start_place})
         for t in transitions:
-            route_distance += t.distance * 1000
-            places[route_distance / 1000] = t.to_place
-        route_distance /= 1000
+            route_distance += to_fixed(t.distance)
+            places[from_fixed(route_distance)] = t.to_place
+        route_distance = from_fixed(route_distance)
 
         instance = super(cls, cls).create(
             route_distance=route_distance, next_check=min(places), places=places, **kwargs
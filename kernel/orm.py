@@ -265,8 +265,17 @@ class QuerySet(object):
         qs = self.get_new_qs()
         qs.base_filters = search_filters
         db_objects = self.model.db_objects
+        results = []
+
+        if search_filters and db_objects.__class__ is not dict and hasattr(db_objects, 'select_pks'):
+            pks = db_objects.select_pks(search_filters, is_first_only)
+            if pks is not None:
+                results = [self.model(pk) for pk in pks]
+                db_objects = {}
+            else:  # filtered here, the rows are read in one query
+                db_objects = db_objects.get_rows()
 
-        if search_filters:
+        if search_filters and db_objects:
             if 'id' in search_filters:
                 pk = search_filters['id']
                 db_objects = {pk: db_objects[pk]} if pk in db_objects else {}
@@ -284,8 +293,6 @@ class QuerySet(object):
             base_group, groups, filters_data = self.parse_search_lookups(search_filters)
             qs_cache_search_groups[qs_cache_key] = (base_group, groups, filters_data)
 
-        results = []
-
         for pk in db_objects:
             if not search_filters:
                 results.append(self.model(pk))
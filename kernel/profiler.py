@@ -0,0 +1,99 @@
+"""
+Phase timers of the simulation. Disabled by default, a disabled phase costs one flag check:
+
+    from kernel.profiler import timers
+    timers.enable()
+    simulation.simulate(hours=8)
+    timers.get_stats('plan')  # {plan title: {phase: {'calls': .., 'seconds': ..}}}
+    timers.dump('phases.json')
+
+Times are inclusive: a route search is also counted in the phase that started it.
+"""
+from __future__ import division
+
+import functools
+import json
+import time
+
+from collections import defaultdict
+
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+DIMENSIONS = ('phase', 'tick', 'character', 'plan')
+
+
+class PhaseTimers(object):
+    def __init__(self):
+        self.is_enabled = False
+        self.tick = None
+        self.character_id = None
+        self.plan = None
+        self.stats = None
+        self.reset()
+
+    def enable(self):
+        self.is_enabled = True
+
+    def disable(self):
+        self.is_enabled = False
+
+    def reset(self):
+        self.stats = {dimension: defaultdict(lambda: defaultdict(lambda: [0, 0.0])) for dimension in DIMENSIONS}
+
+    def set_tick(self, seconds):
+        self.tick = seconds
+
+    def set_character(self, character_id, plan=None):
+        self.character_id = character_id
+        self.plan = plan
+
+    def add(self, name, seconds):
+        for dimension, key in (
+            ('phase', None),
+            ('tick', self.tick),
+            ('character', self.character_id),
+            ('plan', self.plan)
+        ):
+            data = self.stats[dimension][key][name]
+            data[0] += 1
+            data[1] += seconds
+
+    def phase(self, name):
+        """Decorator, calls of the function are timed as the phase when the timers are enabled"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.is_enabled:
+                    return func(*args, **kwargs)
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(name, perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def get_stats(self, dimension='phase'):
+        """{key: {phase: {'calls': .., 'seconds': ..}}}, the key is None for the 'phase' dimension"""
+        return {
+            key: {name: {'calls': calls, 'seconds': round(seconds, 6)} for name, (calls, seconds) in phases.items()}
+            for key, phases in self.stats[dimension].items()
+        }
+
+    def dumps(self):
+        return json.dumps({
+            dimension: {str(k): v for k, v in self.get_stats(dimension).items()} for dimension in DIMENSIONS
+        }, sort_keys=True)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.dumps())
+
+    def print_stats(self, stream):
+        phases = self.get_stats().get(None, {})
+        for name, data in sorted(phases.items(), key=lambda item: -item[1]['seconds']):
+            stream.write(u'{:<20} {:>8} calls {:>10.3f} ms\n'.format(name, data['calls'], data['seconds'] * 1000))
+
+
+timers = PhaseTimers()
+phase = timers.phase
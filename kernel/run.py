@@ -0,0 +1,99 @@
+"""
+Headless batch simulation: every seed is simulated from the loaded world in a process pool,
+one JSON line with the metrics is written per run.
+
+    python -m kernel.run --days 3 --seeds 8 --output runs.jsonl
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from kernel.models import Character
+from kernel.simulation.sim import Simulation
+from kernel.state import Fork
+from kernel.utils import set_world_seed, simulation_stats
+
+
+def get_distribution(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'min': values[0],
+        'max': values[-1],
+        'mean': round(sum(values) / len(values), 3),
+        'median': values[len(values) // 2]
+    }
+
+
+def run_seed(seed, days):
+    """Simulates days from the loaded world with the seed, the world is left unchanged"""
+    simulation_stats.clear()
+    with Fork():
+        set_world_seed(seed)
+        random.seed(seed)
+        simulation = Simulation()
+        seconds_start = simulation.time.seconds
+        time_start = time.time()
+        simulation.simulate(days=days)
+        wall_time = time.time() - time_start
+        seconds_simulated = simulation.time.seconds - seconds_start
+        chars = Character.objects.filter(is_clone=False).instances
+        ticks = simulation_stats['periods']
+        return {
+            'seed': seed,
+            'days': days,
+            'seconds_simulated': seconds_simulated,
+            'wall_time': round(wall_time, 4),
+            'ticks': ticks,
+            'ticks_per_second': round(ticks / wall_time, 2) if wall_time else None,
+            'plans_started': simulation_stats['plans_started'],
+            'routes_computed': simulation_stats['routes_computed'],
+            'characters': len(chars),
+            'stats': {
+                attr_name: get_distribution([getattr(char, attr_name) for char in chars])
+                for attr_name in sorted(Character.objects_effects_fields)
+            }
+        }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Simulate the world for several seeds in parallel')
+    parser.add_argument('--days', type=float, default=1, help='simulated days of every run')
+    parser.add_argument('--seeds', type=int, default=1, help='number of runs')
+    parser.add_argument('--seed-start', type=int, default=0, help='seed of the first run')
+    parser.add_argument('--processes', type=int, default=None, help='pool size, cpu count by default')
+    parser.add_argument('--output', default='-', help='JSONL file, stdout by default')
+    parser.add_argument('--verbose', action='store_true', help='keep the simulation log')
+    return parser
+
+
+def main(args=None):
+    args = get_parser().parse_args(args)
+    if not args.verbose:
+        for logger_name in ('simulation', 'orm', 'route', 'positions'):
+            logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [
+                executor.submit(run_seed, seed, args.days)
+                for seed in range(args.seed_start, args.seed_start + args.seeds)
+            ]
+            for future in as_completed(futures):
+                output.write(json.dumps(future.result(), sort_keys=True) + '\n')
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -9,3 +9,15 @@ PLAYER_ID = 1
 IDLE_PLAN_ID = 1
 START_DT = datetime(year=1, month=1, day=1, hour=9, minute=0, second=0)
 SIMULATE_PERIOD = timedelta(minutes=3)
+SIMULATE_SCHEDULER = True
+SIMULATE_LOD = False  # coarse steps away from the player change the results, the game enables it
+SIMULATE_LOD_PERIOD = timedelta(minutes=30)
+SIMULATE_BUDGET_MS = None  # player actions are simulated in slices, the screen is redrawn between them
+JOURNAL_COMPACT_RECORDS = 50
+STORAGE_ENGINE = 'memory'  # or 'sqlite'
+STORAGE_SQLITE_PATH = None
+STORAGE_SQLITE_CACHE_ROWS = 10000
+SHARDS_PROCESSES = None  # cpu count
+SHARDS_EPOCH_MINUTES = 30
+WORLD_SEED = 0
+MODIFIERS_CACHE_SIZE = 20000  # memoized points mods results, dropped all at once when exceeded
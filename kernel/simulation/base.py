@@ -3,6 +3,7 @@ from __future__ import division
 import logging
 
 from kernel.models import Place
+from kernel.profiler import phase, timers
 from kernel.settings import DEBUG_SIMULATION
 from kernel.simulation.pauses import process_pause, set_plan_pauses
 from kernel.simulation.plans.apply import set_plan_single, set_plan_group
@@ -26,6 +27,7 @@ class SimulationPeriod(object):
 
     def __init__(self, char, period_minutes, period_minutes_left, current_seconds, current_day_seconds):
         self.stage = None
+        self.stage_record = None
         self.is_first = True
         self.current_seconds = current_seconds
         self.current_day_seconds = current_day_seconds
@@ -61,26 +63,12 @@ class SimulationPeriod(object):
 
     def check_stage_finished(self):
         if self.minutes_left <= 0.01:
-            if self.stage.effects_id:
-                if self.stage.filters_id:
-                    return True
-                return False
-            if self.stage.filters_plan_set_id:
-                return False
-            if self.stage.lock_id:
-                return False
-            if self.stage.plan_pause_id:
-                return False
-            if (
-                self.stage.is_filter_stage and
-                (not self.stage.filters.time_min_seconds and not self.stage.filters.time_max_seconds)
-            ):
-                return False
-            return True
+            return self.stage_record.is_finished_in_time
         if player_data['is_break_simulation']:
             return True
         return False
 
+    @phase('set_plan_filters')
     def set_plan_filters(self):
         if self.second_character_id:
             return set_plan_group(
@@ -88,6 +76,7 @@ class SimulationPeriod(object):
             )
         return set_plan_single(self.stage, self.current_seconds, self.current_day_seconds, self.first_character)
 
+    @phase('process_effects')
     def process_effects(self):
         time_passed, self.is_interrupted, self.is_finished = process_effects(
             stage=self.stage,
@@ -99,6 +88,7 @@ class SimulationPeriod(object):
         )
         return time_passed
 
+    @phase('process_route')
     def process_route(self):
         if self.second_character_id:
             return route_group_plan(
@@ -124,9 +114,39 @@ class SimulationPeriod(object):
     def finish_plan(self, is_interrupted=False, pause_seconds=None):
         self.plan_data.finish_plan(self.current_seconds, is_interrupted, pause_seconds)
 
+    def simulate_effects(self):
+        time_passed = self.process_effects()
+        if self.is_interrupted:
+            self.finish_plan(is_interrupted=True)
+        elif self.is_finished or time_passed < self.minutes_left:
+            self.next_stage()
+        return time_passed
+
+    def simulate_route(self):
+        if self.plan_data.first_route_id or self.plan_data.second_route_id:
+            return self.process_route()
+        create_route_plan(self.stage, self.plan_data, self.current_seconds, self.first_character, self.second_character)
+        return 0
+
+    def simulate_lock(self):
+        self.lock_stage()
+        self.next_stage()
+        return 0
+
+    def simulate_pause(self):
+        set_plan_pauses(self.stage.plan_pause, self.first_character_id, self.current_seconds, self.second_character_id)
+        self.next_stage()
+        return 0
+
+    stage_handlers = (None, simulate_effects, simulate_route, simulate_lock, simulate_pause)  # by the stage kind
+
     def simulate(self):
-        stage = getattr(self.plan_data.plan, self.plan_data.plan_stage)
+        record = self.plan_data.get_stage_record()
+        stage = record.stage
         self.stage = stage
+        self.stage_record = record
+        if timers.is_enabled:
+            timers.set_character(self.char_id, self.plan_data.plan.title)
         time_passed = None
 
         if self.check_stage_finished():
@@ -135,11 +155,9 @@ class SimulationPeriod(object):
             logger.info('stage {}'.format(stage))
 
         stage_filters = stage.filters
-        is_time_filters = False
         if stage_filters:
             is_finished = False
-            if stage_filters.time_max_seconds:
-                is_time_filters = True
+            if record.is_time_filters:
                 time_passed = process_pause(
                     self.first_character_id, stage_filters, self.minutes_left, self.current_seconds
                 )
@@ -152,41 +170,22 @@ class SimulationPeriod(object):
             ):
                 if DEBUG_SIMULATION and not stage.is_optional:
                     logger.info('filters not passed')
-                if not stage.is_filter_stage or stage.is_optional:
+                if not record.is_filter_stage or stage.is_optional:
                     self.next_stage()
                 else:
                     self.finish_plan()
                 return time_passed
-            elif stage.is_filter_stage:
+            elif record.is_filter_stage:
                 self.next_stage()
                 return 0
 
-        if stage.filters_plan_set_id and self.set_plan_filters():
+        if record.is_plan_set and self.set_plan_filters():
             stay_until_seconds[self.first_character_id] = 0
             return 0
 
-        if stage.effects_id:
-            time_passed = self.process_effects()
-            if self.is_interrupted:
-                self.finish_plan(is_interrupted=True)
-            elif self.is_finished or time_passed < self.minutes_left:
-                self.next_stage()
-        elif stage.filters_place_id and not is_time_filters:
-            if self.plan_data.first_route_id or self.plan_data.second_route_id:
-                time_passed = self.process_route()
-            else:
-                create_route_plan(
-                    stage, self.plan_data, self.current_seconds, self.first_character, self.second_character
-                )
-                time_passed = 0
-        elif stage.lock_id and not is_time_filters:
-            self.lock_stage()
-            self.next_stage()
-            time_passed = 0
-        elif stage.plan_pause_id and not is_time_filters:
-            set_plan_pauses(stage.plan_pause, self.first_character_id, self.current_seconds, self.second_character_id)
-            self.next_stage()
-            time_passed = 0
+        handler = self.stage_handlers[record.kind]
+        if handler is not None:
+            time_passed = handler(self)
 
         process_natural(time_passed, self.first_character, self.second_character, stage.effects)
         if (
@@ -5,8 +5,9 @@ import logging
 
 from kernel.orm import QuerySet
 from kernel.models import Plan
+from kernel.profiler import phase
 from kernel.settings import IDLE_PLAN_ID
-from kernel.utils import dict_multiply
+from kernel.utils import dict_multiply, fixed_multiply, from_fixed, to_fixed
 
 
 logger = logging.getLogger('simulation')
@@ -174,7 +175,7 @@ def process_effects_group(stage, minutes_left, current_seconds, first_character,
 
 def apply_effects(instance, data):
     instance.update(**{
-        k: (getattr(instance, k) * 1000 + data[k] * 1000) / 1000
+        k: from_fixed(to_fixed(getattr(instance, k)) + to_fixed(data[k]))
         if k in instance.objects_effects_fields else data[k] for k in data
     })
 
@@ -201,7 +202,8 @@ def update_max_effects(effects, effects_max, instance):
             effects[attr_name] = max_value - current_value
 
 
-def update_natural_effects(character, time_passed, needs_mods=None):
+def get_natural_effects(character, needs_mods=None):
+    """Natural change of the character needs per minute"""
     if needs_mods:
         energy_mod = needs_mods['energy']
         sleep_mod = needs_mods['sleep']
@@ -215,19 +217,23 @@ def update_natural_effects(character, time_passed, needs_mods=None):
 
     effects = {}
     if sleep_mod:
-        effects['sleep'] = -(0.7 * 1000 * sleep_mod / 1000)
+        effects['sleep'] = -fixed_multiply(0.7, sleep_mod)
     if energy_mod:
         effect = 0.35
         if character.sleep < 500:
             effect *= 1 + (500 - character.sleep) / 500
     if mood_mod:
-        effects['mood'] = -(0.3 * 1000 * mood_mod / 1000)
+        effects['mood'] = -fixed_multiply(0.3, mood_mod)
     if health_mod:
-        effects['health'] = 0.02 * 1000 * health_mod / 1000
+        effects['health'] = fixed_multiply(0.02, health_mod)
+    return effects
+
 
-    apply_effects(character, dict_multiply(effects, time_passed))
+def update_natural_effects(character, time_passed, needs_mods=None):
+    apply_effects(character, dict_multiply(get_natural_effects(character, needs_mods), time_passed))
 
 
+@phase('process_natural')
 def process_natural(time_passed, first_character, second_character=None, effects_data=None):
     if not time_passed:
         return
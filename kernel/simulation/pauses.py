@@ -1,11 +1,10 @@
 from __future__ import division
 
 import logging
-import random
 
 from kernel.models import Character, Plan
 from kernel.settings import DEBUG_SIMULATION
-from kernel.utils import stay_until_seconds, plan_pauses
+from kernel.utils import get_random, stay_until_seconds, plan_pauses
 
 logger = logging.getLogger('simulation')
 
@@ -13,7 +12,7 @@ logger = logging.getLogger('simulation')
 def process_pause(char_id, stage_filters, period_minutes_left, current_seconds):
     seconds_until = stay_until_seconds[char_id]
     if not seconds_until:
-        seconds_until = round(current_seconds + random.randint(
+        seconds_until = round(current_seconds + get_random('Character', char_id).randint(
             stage_filters.time_min_seconds or 0, stage_filters.time_max_seconds
         ))
         if DEBUG_SIMULATION:
@@ -27,7 +26,7 @@ def process_pause(char_id, stage_filters, period_minutes_left, current_seconds):
         if time_passed > period_minutes_left:
             time_passed = period_minutes_left
             if DEBUG_SIMULATION:
-                minutes = max(round(((seconds_until - current_seconds) / 60 * 100 - 3.0 * 100) / 100, 2), 0)
+                minutes = max(round((seconds_until - current_seconds) / 60 - period_minutes_left, 2), 0)
                 logger.info('{} minutes left'.format(minutes))
     if not time_passed:
         stay_until_seconds[char_id] = 0
@@ -41,18 +40,19 @@ def set_plan_pauses(plan_pause, first_character_id, current_seconds, second_char
             continue
         for title, pause in data.items():
             plan = Plan.objects.get(title=title)
-            plan_pauses[char_id][plan.id] = -1 if pause == -1 else round(current_seconds + pause * 60, 2)
+            seconds_until = -1 if pause == -1 else round(current_seconds + pause * 60, 2)
+            plan_pauses.set(char_id, plan.id, seconds_until)
             if DEBUG_SIMULATION:
                 logger.info('set pause for {}({}) until {}'.format(
-                    plan.title, Character(char_id).title, plan_pauses[char_id][plan.id]
+                    plan.title, Character(char_id).title, seconds_until
                 ))
 
 
 def get_plan_pause(plan_id, char_id, current_seconds, is_log=True):
-    char_pauses = plan_pauses[char_id]
+    char_pauses = plan_pauses.get(char_id)
     if not char_pauses:
         return False
-    seconds_until = char_pauses[plan_id]
+    seconds_until = char_pauses.get(plan_id)
     if not seconds_until:
         return False
     if seconds_until > current_seconds or seconds_until == -1:
@@ -64,5 +64,5 @@ def get_plan_pause(plan_id, char_id, current_seconds, is_log=True):
                 logger.info('{} is disabled by pause seconds'.format(title))
         return True
     else:
-        plan_pauses[char_id][plan_id] = 0
+        plan_pauses.remove(char_id, plan_id)
         return False
@@ -5,25 +5,31 @@ from kernel.settings import DEBUG_SIMULATION
 from kernel.models import EventLog, PlanData, Plan
 from kernel.settings import IDLE_PLAN_ID, PLAYER_ID
 from kernel.simulation.plans.create import GetPlan
-from kernel.utils import ReplacementText
+from kernel.utils import ReplacementText, simulation_stats
 
 logger = logging.getLogger('simulation')
 
 
-def get_and_set_plan(current_seconds, current_day_seconds, char, char_other=None, plan_filters=None, is_break=False):
-    get_plan = GetPlan(
-        current_seconds=current_seconds,
-        current_day_seconds=current_day_seconds,
-        char=char,
-        filters=plan_filters.filters if plan_filters else None,
-        is_random_weighted=plan_filters.is_random_weighted if plan_filters else False,
-        char_other=char_other
-    )
-    plan, char_other = get_plan.get_plan()
+def get_and_set_plan(
+    current_seconds, current_day_seconds, char, char_other=None, plan_filters=None, is_break=False, plan_choice=None
+):
+    """plan_choice is the choice of get_plans, it is used unless the partner's plan was changed since"""
+    if plan_choice and (plan_choice[1] is None or plan_choice[1].plan_data_id == plan_choice[2]):
+        plan, char_other = plan_choice[:2]
+    else:
+        get_plan = GetPlan(
+            current_seconds=current_seconds,
+            current_day_seconds=current_day_seconds,
+            char=char,
+            filters=plan_filters.filters if plan_filters else None,
+            is_random_weighted=plan_filters.is_random_weighted if plan_filters else False,
+            char_other=char_other
+        )
+        plan, char_other = get_plan.get_plan()
     if not plan:
         if plan_filters:
             return False
-        plan_data = PlanData.create(plan=Plan(IDLE_PLAN_ID), plan_stage='two', first_character=char)
+        plan_data = PlanData.create(plan=Plan(IDLE_PLAN_ID), plan_stage=1, first_character=char)
         char.update(plan_data=plan_data)
         if DEBUG_SIMULATION:
             logger.info('plans not found, set plan to {}'.format(Plan(IDLE_PLAN_ID).title))
@@ -33,7 +39,12 @@ def get_and_set_plan(current_seconds, current_day_seconds, char, char_other=None
 
 
 def set_plan(plan, first_character, current_seconds, second_character=None, is_break=False, is_interaction=True):
-    plan_data_data = {'plan': plan, 'plan_stage': 'one', 'first_character': first_character}
+    from kernel.simulation.scheduler import Scheduler
+
+    if Scheduler.current:
+        Scheduler.current.wake(first_character)
+        Scheduler.current.wake(second_character)
+    plan_data_data = {'plan': plan, 'plan_stage': 0, 'first_character': first_character}
     if second_character and plan.filters and plan.filters.is_group:
         if second_character.is_clone and second_character.is_original:
             if second_character.place_id:
@@ -67,6 +78,7 @@ def set_plan(plan, first_character, current_seconds, second_character=None, is_b
                 plan_data_data['second_previous'] = second_plan_data
 
     plan_data = PlanData.create(**plan_data_data)
+    simulation_stats['plans_started'] += 1
     first_character.update(plan_data=plan_data)
     if second_character is not None:
         second_character.update(plan_data=plan_data)
@@ -1,31 +1,188 @@
+import bisect
+import itertools
 import random
-import sys
+import re
 
 from operator import itemgetter
 from kernel import renpy
 from kernel.models import Character, CharacterRelationship, FactionRelationship, Plan
+from kernel.orm import QuerySet
+from kernel.profiler import phase
 from kernel.settings import PLAYER_ID
 from kernel.simulation.pauses import get_plan_pause
 from kernel.simulation.plans.modifiers import CharacterPlanModifiers
 from kernel.utils import (
     ReplacementText,
+    fields_versions,
+    get_compiled_filters,
+    get_filters_key,
     get_filters_replaced,
+    get_random,
     get_value_replaced_second_char,
     is_in_time_range,
-    player_data
+    plan_pauses,
+    plans_eligibility,
+    player_data,
+    qs_cache,
+    qs_cache_relations,
+    shard_characters_ids
 )
 
 
-def random_choice_weights_py3(points):
-    return random.choices(points, weights=points)[0]
+class WeightedSampler(object):
+    """
+    Cumulative weights are built once a candidate set, a draw is one random() and a bisect,
+    draws are the same as of random.choices(population, weights)
+    """
 
+    def __init__(self, population, weights=None):
+        self.population = list(population)
+        self.cum_weights = []
+        total = 0
+        for weight in (self.population if weights is None else weights):
+            total += weight
+            self.cum_weights.append(total)
+        self.total = total + 0.0
 
-def random_choice_weights_py2(points):
-    weights = [(p, p / 10) for p in points]
-    return random.choice(*[[v] * w for v, w in weights])[0]
+    def choice(self, rng=random):
+        return self.population[bisect.bisect(self.cum_weights, rng.random() * self.total, 0, len(self.population) - 1)]
 
 
-random_choice_weights = random_choice_weights_py2 if sys.version_info[0] < 3 else random_choice_weights_py3
+def random_choice_weights(points, rng=random):
+    return WeightedSampler(points).choice(rng)
+
+
+def get_window_minutes(filters):
+    """Minutes of the day the time range of the filters(same as is_in_time_range) touches"""
+    from_seconds = filters.time_from_seconds if filters else None
+    to_seconds = filters.time_to_seconds if filters else None
+    from_minute = min(int(from_seconds // 60), 1439) if from_seconds else 0
+    to_minute = min(int(to_seconds // 60), 1439) if to_seconds else 1439
+    if from_minute <= to_minute:
+        return range(from_minute, to_minute + 1)
+    return itertools.chain(range(from_minute, 1440), range(0, to_minute + 1))
+
+
+def get_plans_time_index(filters):
+    """Plans of the filters in minute of the day buckets by their time ranges, cached until plans are changed"""
+    qs_cache_key = ('PlansTimeIndex', str(filters))
+    cached = qs_cache.get(qs_cache_key)
+    if cached is not None:
+        return cached['queryset']
+    buckets = [[] for _ in range(1440)]
+    for plan in Plan.objects.filter(**filters):
+        for minute in get_window_minutes(plan.filters):
+            buckets[minute].append(plan)
+    qs_cache[qs_cache_key] = {'queryset': buckets, 'relations': ['Plan', 'PlanFilters']}
+    for model_name in ('Plan', 'PlanFilters'):
+        qs_cache_relations[model_name].append(qs_cache_key)
+    return buckets
+
+
+filters_dependencies = {}
+
+
+def get_filters_dependencies(model, lookups):
+    """Fields of the row and names of the related tables the lookups read, keys of fields_versions"""
+    key = (model.__name__, tuple(sorted(lookups)))
+    dependencies = filters_dependencies.get(key)
+    if dependencies is not None:
+        return dependencies
+    fields = set()
+    tables = set()
+    for lookup in lookups:
+        if re.search(r'__or([0-9])?(a)?([0-9])?$', lookup):
+            lookup = lookup.rsplit('__', 1)[0]
+        relations, field_name, cmd = QuerySet.parse_filter(lookup)
+        if not relations:
+            fields.add(field_name)
+            continue
+        relation_model = model
+        for inx, relation in enumerate(relations):
+            if relation in relation_model.mto_data:
+                data = relation_model.mto_data[relation]
+                if not inx:
+                    fields.add(data['from_id'])
+            elif relation in relation_model.mtm_data:
+                data = relation_model.mtm_data[relation]
+                tables.add(data['through']['name'])
+            elif relation in relation_model.set_data:
+                data = relation_model.set_data[relation]
+            else:
+                tables.add(relation_model.__name__)
+                break
+            relation_model = data['model']
+            tables.add(relation_model.__name__)
+    dependencies = (tuple(sorted(fields)), tuple(sorted(tables)))
+    filters_dependencies[key] = dependencies
+    return dependencies
+
+
+def get_eligibility_versions(char_id, qs_filters):
+    fields, tables = get_filters_dependencies(Character, qs_filters)
+    return tuple(fields_versions.get(('Character', char_id, field), 0) for field in fields) + tuple(
+        fields_versions.get(table, 0) for table in tables
+    )
+
+
+def get_plans_filters(filters=None):
+    """Filters of the plans a character chooses from, the available ones by default"""
+    return filters or {'is_char_available': True}
+
+
+def is_filters_replaced(filters):
+    """Filters have values of the character(_place_id, _second_char__...) or check its id"""
+    if any(k == 'id' or k.startswith('id__') for k in filters):
+        return True
+    for lookup, is_list, is_getter, value in get_compiled_filters(filters)[1]:
+        if is_getter or (is_list and any(is_getter_ for is_getter_, v in value)):
+            return True
+    return False
+
+
+@phase('plans_eligibility')
+def set_plans_eligibility(chars, current_day_seconds, filters=None):
+    """
+    Checks first character filters of the plans available at the day time for all the characters with one query
+    a plan, results go to the eligibility cache GetPlan.get_plan reads. Filters with values of the character
+    are left to get_plan.
+    """
+    chars_ids = {char.id for char in chars}
+    for plan in get_plans_time_index(get_plans_filters(filters))[int(current_day_seconds // 60) % 1440]:
+        plan_filters = plan.filters
+        filters_first = plan_filters.first_character if plan_filters else None
+        filters_first_filters = filters_first.filters if filters_first else None
+        if not filters_first_filters or is_filters_replaced(filters_first_filters):
+            continue
+        passed_ids = set(Character.objects.filter(id__in=chars_ids, **filters_first_filters).values_list('id'))
+        filters_key = get_filters_key(filters_first_filters, None)
+        for char_id in chars_ids:
+            plans_eligibility[(char_id, plan.id)] = (
+                filters_key, get_eligibility_versions(char_id, filters_first_filters), char_id in passed_ids
+            )
+
+
+def get_plans(chars, current_seconds, current_day_seconds):
+    """
+    Plans of the idle characters chosen in one pass, {char id: (plan, second character, its plan data id)}.
+    The characters choose in the order of the simulation: a character chosen by an earlier one and the characters
+    whose choice has a character taken already(a partner or one with a plan) are left to choose on their turn
+    """
+    set_plans_eligibility(chars, current_day_seconds)
+    plans = {}
+    taken_ids = set()
+    for char in chars:
+        if char.id in taken_ids:
+            continue
+        plan, second_character = GetPlan(current_seconds, current_day_seconds, char).get_plan()
+        if second_character is not None and plan.filters.is_group:
+            if second_character.id in taken_ids:
+                continue
+            if not (second_character.is_clone and second_character.is_original):  # the original is cloned
+                taken_ids.add(second_character.id)
+        taken_ids.add(char.id)
+        plans[char.id] = (plan, second_character, second_character.plan_data_id if second_character else None)
+    return plans
 
 
 class GetPlan(object):
@@ -44,7 +201,7 @@ class GetPlan(object):
         self.char_id = char.id
         self.char_other = char_other
         self.char_other_id = char_other.id if char_other else None
-        self.filters = filters or {'is_char_available': True}
+        self.filters = get_plans_filters(filters)
         self.is_random_weighted = is_random_weighted
         self.is_player = char.id == PLAYER_ID
 
@@ -54,7 +211,8 @@ class GetPlan(object):
         second_chars = Character.objects.filter(**qs_filters).instances
         second_chars = [
             char for char in second_chars
-            if not get_plan_pause(plan.id, char.id, self.current_seconds, is_log=False) and char.id != self.char_id
+            if not get_plan_pause(plan.id, char.id, self.current_seconds, is_log=False) and char.id != self.char_id and
+            (not shard_characters_ids or char.id in shard_characters_ids)
         ]
         if not second_chars:
             return
@@ -148,11 +306,32 @@ class GetPlan(object):
 
         return second_char
 
+    def is_first_char_eligible(self, plan, filters):
+        """
+        First character filters of the plan, the result is cached for the character until the filters values
+        or versions of the fields and the tables they read are changed
+        """
+        versions = get_eligibility_versions(self.char_id, filters)
+        key = (self.char_id, plan.id)
+        filters_key = get_filters_key(filters, self.char, self.char_other)
+        cached = plans_eligibility.get(key)
+        if cached is not None and cached[0] == filters_key and cached[1] == versions:
+            return cached[2]
+        qs_filters = get_filters_replaced(filters, self.char, self.char_other)
+        if 'id' not in qs_filters:
+            qs_filters['id'] = self.char_id
+        is_eligible = bool(Character.objects.filter(**qs_filters))
+        plans_eligibility[key] = (filters_key, versions, is_eligible)
+        return is_eligible
+
+    @phase('get_plan')
     def get_plan(self):
         options_points = {}
 
-        for plan in Plan.objects.filter(**self.filters):
-            if get_plan_pause(plan.id, self.char_id, self.current_seconds):
+        minute = int(self.current_day_seconds // 60) % 1440
+        paused_plans_ids = plan_pauses.get_paused(self.char_id, self.current_seconds)
+        for plan in get_plans_time_index(self.filters)[minute]:
+            if plan.id in paused_plans_ids and get_plan_pause(plan.id, self.char_id, self.current_seconds):
                 continue
 
             filters = plan.filters
@@ -170,17 +349,12 @@ class GetPlan(object):
             if filters_first:
                 filters_first_filters = filters_first.filters
                 if filters_first_filters:
-                    qs_filters = get_filters_replaced(
-                        filters_first_filters, self.char, self.char_other
-                    )
                     if 'id' in filters_first_filters:
                         if get_value_replaced_second_char(
                                 filters_first_filters['id'], self.char, self.char_other
                         ) != self.char_id:
                             continue
-                    else:
-                        qs_filters['id'] = self.char_id
-                    if not Character.objects.filter(**qs_filters):
+                    if not self.is_first_char_eligible(plan, filters_first_filters):
                         continue
 
             if filters.second_character:
@@ -224,7 +398,7 @@ class GetPlan(object):
             if points <= 100:
                 continue
             if points in options_points:
-                points += random.uniform(-.0000001, .0000001)
+                points += get_random('Character', self.char_id).uniform(-.0000001, .0000001)
             options_points[points] = (plan, second_character)
 
         if not options_points:
@@ -249,5 +423,5 @@ class GetPlan(object):
                 second_character = None
             return plan, second_character
         if self.is_random_weighted:
-            return options_points[random_choice_weights(list(options_points))]
+            return options_points[random_choice_weights(list(options_points), get_random('Character', self.char_id))]
         return options_points[max(options_points)]
@@ -1,7 +1,14 @@
 from __future__ import division
 
+from kernel.settings import MODIFIERS_CACHE_SIZE
+from kernel.utils import compiled_mods, fields_versions, modifiers_results
+
 
 class PlanModifiers(object):
+    """
+    Points mods are compiled once a structure text into flat terms(is negative, target, attrs type, attrs names),
+    results are memoized by the versions of the attributes they read
+    """
     value_min = 100
     value_max = 1000
 
@@ -9,12 +16,91 @@ class PlanModifiers(object):
         self.instance = instance
         self.points_mods = points_mods
 
+    @classmethod
+    def compile(cls, points_mods):
+        return [(False, 0, attrs_type_key, attrs) for attrs_type_key, attrs in points_mods.items()]
+
+    def get_compiled(self):
+        """
+        (mods text, terms, targets, is relationship), targets are (target, attrs names) the terms read,
+        the opinion is read as the relationship attribute
+        """
+        key = (self.__class__.__name__, str(self.points_mods))
+        compiled = compiled_mods.get(key)
+        if compiled is None:
+            terms = []
+            targets = {}
+            for is_negative, target, attrs_type_key, attrs in self.compile(self.points_mods):
+                names = (attrs,) if attrs_type_key == 'exact' else tuple(attrs)
+                if attrs_type_key not in ('exact', 'max', 'min', 'avg'):
+                    raise ValueError('Value not found')
+                terms.append((is_negative, target, attrs_type_key, names))
+                targets.setdefault(target, set()).update(names)
+            is_relationship = any('relationship' in names for names in targets.values())
+            targets = [(target, frozenset(names) - {'relationship'}) for target, names in sorted(targets.items())]
+            compiled = (key[1], terms, targets, is_relationship)
+            compiled_mods[key] = compiled
+        return compiled
+
+    def get_instances(self):
+        return self.instance,
+
+    def get_relationships(self):
+        return None,
+
+    @staticmethod
+    def get_versions(instances, targets, is_relationship):
+        """Versions of the rows read, None if an attribute is not a field of the row(its changes are not versioned)"""
+        versions_get = fields_versions.get
+        versions = [versions_get('CharacterRelationship', 0)] if is_relationship else []
+        for target, names in targets:
+            instance = instances[target]
+            klass = instance.__class__
+            if not klass.objects_fields.issuperset(names):
+                return None
+            versions.append(versions_get((klass.__name__, instance.pk), 0))
+        return tuple(versions)
+
     def get(self):
+        mods_key, terms, targets, is_relationship = self.get_compiled()
+        instances = self.get_instances()
+        versions = self.get_versions(instances, targets, is_relationship)
+        key = (self.__class__, mods_key, self.get_flags()) + tuple(
+            (instance.__class__, instance.pk) if instance is not None else None for instance in instances
+        )
+        cached = modifiers_results.get(key) if versions is not None else None
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        relationships = self.get_relationships()
         values = []
-        for attrs_type_key in self.points_mods:
-            attrs_type_values = self.points_mods[attrs_type_key]
-            values.append(self.get_modified_effect(self.instance, attrs_type_key, attrs_type_values) * 10)
-        return sum(values) / (len(values) * 10)
+        for is_negative, target, attrs_type_key, names in terms:
+            instance = instances[target]
+            attrs = [
+                relationships[target] if name == 'relationship' else getattr(instance, name) for name in names
+            ]
+            if attrs_type_key == 'exact' or attrs_type_key == 'max':
+                value = max(attrs)
+            elif attrs_type_key == 'min':
+                value = min(attrs)
+            else:
+                value = sum(attrs) / len(attrs)
+            if value > self.value_max:
+                value = self.value_max
+            elif value < self.value_min:
+                value = self.value_min
+            if is_negative:
+                value = self.value_max - value
+            values.append(value * 10)
+        result = sum(values) / (len(values) * 10)
+        if versions is not None:
+            if len(modifiers_results) >= MODIFIERS_CACHE_SIZE:
+                modifiers_results.clear()
+            modifiers_results[key] = (versions, result)
+        return result
+
+    def get_flags(self):
+        return ()
 
     def get_mod(self, value=None):
         mod = self.get() / 500
@@ -25,43 +111,15 @@ class PlanModifiers(object):
             return round(mod_value, 4)
         return mod
 
-    def get_modified_effect(self, instance, attr_key, attr_value):
-        if attr_key == 'exact':
-            value = getattr(instance, attr_value)
-        else:
-            attrs = [getattr(instance, name) for name in attr_value]
-            if attr_key == 'max':
-                value = max(attrs)
-            elif attr_key == 'min':
-                value = min(attrs)
-            elif attr_key == 'avg':
-                value = sum(attrs) / len(attrs)
-            else:
-                raise ValueError('Value not found')
-        if value > self.value_max:
-            value = self.value_max
-        elif value < self.value_min:
-            value = self.value_min
-        return value
-
 
 class PlanModifiersPosNeg(PlanModifiers):
-    def get(self):
-        values = []
-        for pos_neg_key in self.points_mods:
-            pos_neg_values = self.points_mods[pos_neg_key]
-            for attrs_type_key in pos_neg_values:
-                attrs_type_values = pos_neg_values[attrs_type_key]
-                values.append(
-                    self.get_modified_effect(pos_neg_key, self.instance, attrs_type_key, attrs_type_values) * 10
-                )
-        return sum(values) / (len(values) * 10)
-
-    def get_modified_effect(self, pos_neg_key, *args):
-        value = super(PlanModifiersPosNeg, self).get_modified_effect(*args)
-        if pos_neg_key == 'negative':
-            value = self.value_max - value
-        return value
+    @classmethod
+    def compile(cls, points_mods):
+        return [
+            (pos_neg_key == 'negative', 0, attrs_type_key, attrs)
+            for pos_neg_key, pos_neg_values in points_mods.items()
+            for attrs_type_key, attrs in pos_neg_values.items()
+        ]
 
 
 class CharacterPlanModifiers(PlanModifiersPosNeg):
@@ -71,31 +129,27 @@ class CharacterPlanModifiers(PlanModifiersPosNeg):
         self.is_relationships_own = is_relationships_own
         self.is_relationships_other = is_relationships_other
 
-    def get(self):
-        char_own = self.instance
-        char_other = self.char_other
+    @classmethod
+    def compile(cls, points_mods):
+        return [
+            (pos_neg_key == 'negative', 0 if own_other_key == 'own' else 1, attrs_action_key, attrs)
+            for pos_neg_key, pos_neg_values in points_mods.items()
+            for own_other_key, own_other_values in pos_neg_values.items()
+            for attrs_action_key, attrs in own_other_values.items()
+        ]
 
-        if char_other is not None:
-            relationship_own = char_own.get_opinion(char_other.id) if self.is_relationships_own else None
-            relationship_other = char_other.get_opinion(char_own.id) if self.is_relationships_other else None
-        else:
-            relationship_own = None
-            relationship_other = None
+    def get_instances(self):
+        return self.instance, self.char_other
 
-        values = []
-        for pos_neg_key in self.points_mods:
-            pos_neg_values = self.points_mods[pos_neg_key]
-            for own_other_key in pos_neg_values:
-                own_other_values = pos_neg_values[own_other_key]
-                if own_other_key == 'own':
-                    char = char_own
-                    char.relationship = relationship_own
-                else:
-                    char = char_other
-                    char.relationship = relationship_other
-                for attrs_action_key in own_other_values:
-                    attrs = own_other_values[attrs_action_key]
-                    values.append(self.get_modified_effect(pos_neg_key, char, attrs_action_key, attrs) * 10)
-                del char.relationship
-
-        return sum(values) / (len(values) * 10)
+    def get_flags(self):
+        return bool(self.is_relationships_own), bool(self.is_relationships_other)
+
+    def get_relationships(self):
+        char_own = self.instance
+        char_other = self.char_other
+        if char_other is None:
+            return None, None
+        return (
+            char_own.get_opinion(char_other.id) if self.is_relationships_own else None,
+            char_other.get_opinion(char_own.id) if self.is_relationships_other else None
+        )
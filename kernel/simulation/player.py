@@ -1,4 +1,5 @@
 from kernel.models import Place, Plan
+from kernel.settings import SIMULATE_BUDGET_MS
 from kernel.simulation.plans.apply import set_plan
 from kernel.simulation.plans.create import GetPlan
 from kernel.simulation.routes.create import create_route_targeted
@@ -13,6 +14,13 @@ class PlayerController(object):
         self.plan_travelling = Plan.objects.get(title='player_travelling_game')
         self.plan_waiting = Plan.objects.get(title='player_waiting_game')
 
+    def simulate(self, **time_kwargs):
+        simulation = self.simulation
+        simulation.simulate(budget_ms=SIMULATE_BUDGET_MS, **time_kwargs)
+        while simulation.seconds_left:
+            renpy.exports.pause(0)
+            simulation.simulate(budget_ms=SIMULATE_BUDGET_MS, seconds=simulation.seconds_left)
+
     def get_plan(self):
         return GetPlan(
             current_seconds=self.simulation.time.seconds,
@@ -47,7 +55,7 @@ class PlayerController(object):
             renpy.exports.say(None, 'Path not found.')
             return
         plan_data.update(first_route=route)
-        self.simulation.simulate()
+        self.simulate()
 
     def choose_plan(self):
         player_data['is_choose_plan'] = True
@@ -55,7 +63,7 @@ class PlayerController(object):
         if plan:
             with renpy.store.SayScreenHide():
                 set_plan(plan, self.player, self.simulation.time.seconds, second_character)
-                self.simulation.simulate()
+                self.simulate()
         elif player_data['is_plans_not_found']:
             with renpy.store.SayScreenHide():
                 renpy.exports.say(None, 'Actions not found.')
@@ -65,7 +73,7 @@ class PlayerController(object):
         player_data['suitable_places'] = []
         self.player.plan_data.next_or_finish(self.simulation.time.seconds)
         with renpy.store.SayScreenHide():
-            self.simulation.simulate()
+            self.simulate()
 
     def cancel_plan(self):
         player_data['suitable_places'] = []
@@ -74,7 +82,7 @@ class PlayerController(object):
     def wait(self):
         with renpy.store.SayScreenHide():
             set_plan(self.plan_waiting, self.player, self.simulation.time.seconds, is_interaction=False)
-            self.simulation.simulate(minutes=15)
+            self.simulate(minutes=15)
         plan_data = self.player.plan_data
         if plan_data and plan_data.plan is self.plan_waiting:
             plan_data.finish_plan(self.simulation.time.seconds)
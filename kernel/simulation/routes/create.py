@@ -4,8 +4,9 @@ import random
 
 from kernel.settings import DEBUG_SIMULATION, PLAYER_ID
 from kernel.models import Place, Route
+from kernel.profiler import phase
 from kernel.simulation.routes.search import RouteSearch
-from kernel.utils import get_filters_replaced, route_locked_places, player_data
+from kernel.utils import get_filters_replaced, get_random, route_locked_places, player_data, simulation_stats
 
 logger = logging.getLogger('simulation')
 
@@ -81,9 +82,10 @@ class RouteCreate(object):
 
         is_random = self.filters_data.is_random
         attrs_importance = self.filters_data.attrs_importance
+        rng = get_random('Character', self.first_character.id)
         place_points = {}
         for p in places:
-            place_points[get_place_points(p, attrs_importance, is_random)] = p
+            place_points[get_place_points(p, attrs_importance, is_random, rng)] = p
         if not place_points:
             if DEBUG_SIMULATION:
                 logger.info('not found place for teleportation')
@@ -115,14 +117,14 @@ class RouteCreate(object):
             self.second_character.update(**self.second_character_update_data)
 
 
-def get_place_points(place, attrs_importance=None, is_random=False):
+def get_place_points(place, attrs_importance=None, is_random=False, rng=random):
     if attrs_importance:
         points = sum(
-            (random.randint(100, 1000) if k == 'random' else getattr(place, k)) * v
+            (rng.randint(100, 1000) if k == 'random' else getattr(place, k)) * v
             for k, v in attrs_importance.items()
         )
     else:
-        points = random.randint(100, 1000) if is_random else 500
+        points = rng.randint(100, 1000) if is_random else 500
     return points
 
 
@@ -141,6 +143,7 @@ def create_route(filters_data, first_character, second_character=None, from_plac
         return None, 'not_found'
 
     is_random = filters_data.is_random
+    rng = get_random('Character', first_character.id)
     is_nearest = 0
     attrs_importance = filters_data.attrs_importance
     distance_penalty = filters_data.distance_penalty
@@ -159,7 +162,7 @@ def create_route(filters_data, first_character, second_character=None, from_plac
                 max_distance = search.distance
                 nearest_transitions = search.transitions
             continue
-        points = get_place_points(p, attrs_importance, is_random)
+        points = get_place_points(p, attrs_importance, is_random, rng)
         if distance_penalty:
             points -= distance_penalty * search.distance
         place_routes_points[points] = search.transitions
@@ -181,6 +184,7 @@ def create_route(filters_data, first_character, second_character=None, from_plac
         second_character=second_character,
         start_place_id=from_place_id
     )
+    simulation_stats['routes_computed'] += 1
     route.suitable_places = []
     if first_character.id == PLAYER_ID:
         if is_nearest:
@@ -221,10 +225,12 @@ def create_route_targeted(to_place_id, first_character, second_character=None, m
         start_place=from_place,
         is_targeted=True
     )
+    simulation_stats['routes_computed'] += 1
     route.suitable_places = [search.transitions[-1].to_place] if first_character.id == PLAYER_ID else []
     return route, 'in_progress'
 
 
+@phase('create_route_plan')
 def create_route_plan(stage, plan_data, current_seconds, first_character, second_character=None):
     route_create = RouteCreate(stage.filters_place, first_character, second_character)
     route_create.run()
@@ -1,6 +1,5 @@
 import itertools
 import logging
-import random
 
 from kernel.models import Plan
 from kernel.settings import DEBUG_SIMULATION, IDLE_PLAN_ID, PLAYER_ID
@@ -8,13 +7,14 @@ from kernel.simulation.effects import update_max_effects, apply_settlement_effec
 from kernel.simulation.plans.create import GetPlan
 from kernel.simulation.plans.apply import set_plan
 from kernel.simulation.routes.create import create_route
-from kernel.utils import route_locked_places, dict_multiply, player_data
+from kernel.utils import get_random, lod_characters_ids, route_locked_places, dict_multiply, player_data
 
 logger = logging.getLogger('simulation')
 
 
 class RouteProgress(object):
     ENCOUNTER_PER_KM = 0.10
+    MINUTES_PER_KM = 10  # 100 meters per minute, the scheduler predicts the arrivals with it
     IS_ROUTE_ENCOUNTERS = True
 
     def __init__(
@@ -49,6 +49,7 @@ class RouteProgress(object):
         self.char_id = char.id
         self.char_other_id = char_other.id if char_other else None
         self.second_character = self.route.second_character if self.route else None
+        self.is_lod = self.char_id in lod_characters_ids  # far from the player, no encounters
 
     def __str__(self):
         if self.char_other_id:
@@ -74,20 +75,19 @@ class RouteProgress(object):
         if route.first_character.is_chained:
             raise ValueError('Character is chained')
 
-        # 100 meters per minute
         time_to_pass = (self.minutes_left * 1000 - self.time_passed * 1000) / 1000
-        distance_time_left = round((route.route_distance - route.distance_passed) * 10, 4)
+        distance_time_left = round((route.route_distance - route.distance_passed) * self.MINUTES_PER_KM, 4)
         if time_to_pass > distance_time_left:
             time_to_pass = distance_time_left
 
         next_distances = list(route.places)[1:]
         next_distances.append(None)
-        distance_max = round(route.distance_passed + time_to_pass / 10, 4)
+        distance_max = round(route.distance_passed + time_to_pass / self.MINUTES_PER_KM, 4)
 
         if self.encounter_on:
             distance_encounter = self.encounter_on
-        elif self.ENCOUNTER_PER_KM:
-            distance_encounter = round(random.uniform(
+        elif self.ENCOUNTER_PER_KM and not self.is_lod:
+            distance_encounter = round(get_random('Character', route.first_character_id).uniform(
                 route.distance_passed, route.distance_passed + self.ENCOUNTER_PER_KM
             ), 3)
         else:
@@ -122,7 +122,7 @@ class RouteProgress(object):
                         qs_filters = {'is_route__or9': True, 'is_encounter__or9': True}
                     else:
                         qs_filters = {'is_encounter': True}
-                elif self.IS_ROUTE_ENCOUNTERS:
+                elif self.IS_ROUTE_ENCOUNTERS and not self.is_lod:
                     qs_filters = {'is_route': True}
                 else:
                     qs_filters = {}
@@ -155,7 +155,7 @@ class RouteProgress(object):
                 if self.char.place is not place:
                     self.passed_places.append(place)
 
-            self.time_passed = round((distance_passed - route.distance_passed) * 10, 4)
+            self.time_passed = round((distance_passed - route.distance_passed) * self.MINUTES_PER_KM, 4)
             if self.status != 'in_progress':
                 break
 
@@ -2,6 +2,8 @@ import logging
 
 from kernel.settings import DEBUG_ROUTE_SEARCH
 from kernel.models import Place, PlaceTransition
+from kernel.profiler import phase
+from kernel.utils import from_fixed, to_fixed
 
 
 logger = logging.getLogger('route')
@@ -86,6 +88,7 @@ class RouteSearch:
                 logger.info('transitions not found')
             logger.info('*' * 40)
 
+    @phase('route_search')
     def run(self):
         if self.from_place_id == self.to_place_id:
             self.transitions = []
@@ -106,5 +109,4 @@ class RouteSearch:
 
     @staticmethod
     def get_route_distance(route):
-        # https://docs.python.org/3/tutorial/floatingpoint.html
-        return sum([r.distance*1000 for r in route]) / 1000
+        return from_fixed(sum([to_fixed(r.distance) for r in route]))
@@ -0,0 +1,334 @@
+from __future__ import division
+
+import heapq
+import logging
+
+from kernel.models import Character
+from kernel.orm import QuerySet
+from kernel.profiler import timers
+from kernel.settings import DEBUG_SIMULATION, PLAYER_ID, SIMULATE_LOD_PERIOD, SIMULATE_PERIOD
+from kernel.simulation.base import SimulationPeriod
+from kernel.simulation.effects import get_natural_effects
+from kernel.simulation.plans.apply import get_and_set_plan
+from kernel.simulation.routes.progress import RouteProgress
+from kernel.utils import group_times, lod_characters_ids, stay_until_seconds
+
+logger = logging.getLogger('simulation')
+
+
+def get_minutes_to(value, target, rates):
+    """Minutes until the value changed with any of the rates reaches the target"""
+    minutes = [(target - value) / rate for rate in rates if rate]
+    minutes = [m for m in minutes if m >= 0]
+    return min(minutes) if minutes else None
+
+
+def get_window_seconds_left(day_seconds, stage_filters):
+    """Seconds until the day time leaves the stage time range"""
+    from_seconds = stage_filters.time_from_seconds
+    to_seconds = stage_filters.time_to_seconds
+    if to_seconds:
+        if day_seconds > to_seconds:
+            return to_seconds + 86400 - day_seconds
+        return to_seconds - day_seconds
+    if from_seconds:
+        return 86400 - day_seconds
+    return None
+
+
+def get_wake_seconds(char, current_seconds, thresholds=()):
+    """
+    Seconds when the character stage can end or change its course, None if the character has to be simulated
+    every period. Only single plans with constant effects are predictable: timed effects, stays and routes
+    without encounters. thresholds are (attribute, value) the attributes must not go below unnoticed.
+    """
+    if group_times[char.id]:
+        return None
+    plan_data = char.plan_data
+    if plan_data is None or plan_data.second_character_id:
+        return None
+    stage = plan_data.get_stage()
+    if (
+        stage is None or
+        stage.is_filter_stage or
+        stage.filters_plan_set_id or
+        stage.lock_id or
+        stage.plan_pause_id
+    ):
+        return None
+
+    stage_filters = stage.filters
+    is_time_filters = bool(stage_filters and stage_filters.time_max_seconds)
+    events = []
+    effects = {}
+    effects_set = stage.effects
+    effects_data = effects_set.first_character if effects_set else None
+    natural = get_natural_effects(char, effects_data.needs_mods if effects_data else None)
+
+    if stage.effects_id:
+        if effects_set.is_instant or not stage.filters_id or effects_data is None:
+            return None
+        if effects_data.effects_sep or effects_data.effects_replacements or effects_data.relationships_effects:
+            return None
+        effects = effects_data.get_effects(char)
+        if set(effects) - char.objects_effects_fields:
+            return None
+        for attr_name, max_value in effects_data.effects_max.items():
+            value = getattr(char, attr_name)
+            if value > max_value:
+                effects.pop(attr_name, None)
+                minutes = get_minutes_to(value, max_value, [natural.get(attr_name, 0)])
+            else:
+                minutes = get_minutes_to(value, max_value, [effects.get(attr_name, 0)])
+            if minutes is not None:
+                events.append(minutes * 60)
+    elif stage.filters_place_id and not is_time_filters:
+        if (RouteProgress.ENCOUNTER_PER_KM or RouteProgress.IS_ROUTE_ENCOUNTERS) and char.id not in lod_characters_ids:
+            return None
+        route = plan_data.first_route
+        if route is None or route.status != 'in_progress':
+            return None
+        events.append((route.route_distance - route.distance_passed) * RouteProgress.MINUTES_PER_KM * 60)
+    elif not is_time_filters:
+        return None
+
+    if stage_filters:
+        if is_time_filters:
+            seconds_until = stay_until_seconds[char.id]
+            if not seconds_until:
+                return None
+            events.append(seconds_until - current_seconds)
+        window_seconds_left = get_window_seconds_left(current_seconds % 86400, stage_filters)
+        if window_seconds_left is not None:
+            events.append(window_seconds_left)
+
+        filters_data = stage_filters.first_character
+        if filters_data is not None:
+            if filters_data.acceptance_points_base:
+                return None
+            for lookup, value in (filters_data.filters or {}).items():
+                relations, field_name, cmd = QuerySet.parse_filter(lookup)
+                if field_name in effects:
+                    rates = [effects[field_name], effects[field_name] + natural.get(field_name, 0)]
+                else:
+                    rates = [natural.get(field_name, 0)]
+                if not any(rates):
+                    if relations:
+                        return None
+                    continue
+                if relations or cmd not in ('gt', 'gte', 'lt', 'lte') or isinstance(value, bool):
+                    return None
+                if not isinstance(value, (int, float)):
+                    return None
+                char_value = getattr(char, field_name)
+                if not QuerySet.check_command_condition(cmd, char_value, value):
+                    return None
+                minutes = get_minutes_to(char_value, value, rates)
+                if minutes is not None:
+                    events.append(minutes * 60)
+
+    for attr_name, value in thresholds:
+        minutes = get_minutes_to(
+            getattr(char, attr_name), value, [effects.get(attr_name, 0) + natural.get(attr_name, 0)]
+        )
+        if minutes is not None:
+            events.append(minutes * 60)
+
+    return current_seconds + min(events) if events else float('inf')
+
+
+def get_lod_settlement_id(char):
+    place = char.place
+    if place is not None and place.settlement_id:
+        return place.settlement_id
+    return char.settlement_id
+
+
+def simulate_character(char, period_ms, current_ms):
+    """Simulates not player character with one period of period_ms since current_ms, the time is kept in integer ms"""
+    minutes = round(period_ms / 60000, 4)
+    passed_ms = 0
+    time_passed = 0
+    if timers.is_enabled:
+        timers.set_character(char.id)
+    while time_passed is not None:
+        current_seconds = current_ms / 1000
+        current_day_seconds = current_ms % 86400000 / 1000
+        if char.plan_data is None:
+            get_and_set_plan(current_seconds, current_day_seconds, char)
+            continue
+        time_passed = SimulationPeriod(
+            char, minutes, (period_ms - passed_ms) / 60000, current_seconds, current_day_seconds
+        ).simulate()
+        if not time_passed:
+            continue
+        time_passed_ms = int(round(time_passed * 60000))
+        passed_ms += time_passed_ms
+        current_ms += time_passed_ms
+
+
+class Scheduler(object):
+    """
+    Characters with a predictable stage are taken out of the periods until their next event
+    and simulated with one long period when woken up.
+    With is_lod characters outside the player's settlement are simulated once in SIMULATE_LOD_PERIOD
+    without route encounters, they get the full detail again when the player comes to their settlement.
+    Times are integer milliseconds of the game clock(Time.ms).
+    The player is never dormant, but a predictable plan of the player bounds the periods skipped
+    when everybody else is dormant, the player is simulated with one long period then.
+    """
+    current = None
+    player_thresholds = (('health', 101), ('energy', 101))  # checked by the main loop every period
+
+    def __init__(self, is_lod=False):
+        self.wake_margin_ms = int(SIMULATE_PERIOD.total_seconds() * 1000)
+        self.is_lod = is_lod
+        self.lod_ms = int(SIMULATE_LOD_PERIOD.total_seconds() * 1000)
+        self.player_settlement_id = None
+        self.detail_lowered_ms = None
+        self.heap = []
+        self.dormant = {}
+        self.visited = set()
+        self.period_start_ms = None
+        self.period_end_ms = None
+
+    @classmethod
+    def start(cls, is_lod=False):
+        cls.current = cls(is_lod)
+        return cls.current
+
+    def finish(self, ms):
+        self.wake_all(ms)
+        lod_characters_ids.clear()
+        Scheduler.current = None
+
+    @classmethod
+    def drop(cls):
+        """Forgets the scheduler without waking the characters, the rows it simulated are replaced"""
+        lod_characters_ids.clear()
+        cls.current = None
+
+    def start_period(self, ms, period_ms):
+        self.period_start_ms = ms
+        self.period_end_ms = ms + period_ms
+        self.visited = set()
+        while self.heap and self.heap[0][0] <= ms:
+            wake_ms, char_id = heapq.heappop(self.heap)
+            if self.dormant.get(char_id, (None, None))[1] == wake_ms:
+                char = Character(char_id)
+                self.catch_up(char, ms)
+                if char_id in lod_characters_ids:  # the next coarse step starts right away
+                    self.sleep(char, ms)
+        if self.is_lod:
+            self.update_lod(ms)
+
+    def update_lod(self, ms):
+        """Characters of the settlement the player came to are simulated in detail from now"""
+        settlement_id = get_lod_settlement_id(Character(PLAYER_ID))
+        if settlement_id == self.player_settlement_id:
+            return
+        self.player_settlement_id = settlement_id
+        for char_id in list(lod_characters_ids):
+            char = Character(char_id)
+            if get_lod_settlement_id(char) != settlement_id:
+                continue
+            if char_id in self.dormant:
+                self.catch_up(char, ms)
+            lod_characters_ids.discard(char_id)
+
+    def lower_detail(self, ms):
+        """Simulation is behind its budget: far characters get LOD, then longer steps(once in a step)"""
+        if self.detail_lowered_ms is not None and ms < self.detail_lowered_ms + self.lod_ms:
+            return
+        self.detail_lowered_ms = ms
+        if not self.is_lod:
+            self.is_lod = True
+        elif self.lod_ms < SIMULATE_LOD_PERIOD.total_seconds() * 1000 * 8:
+            self.lod_ms *= 2
+        else:
+            return
+        if DEBUG_SIMULATION:
+            logger.info('lower detail, LOD step {} seconds'.format(self.lod_ms / 1000))
+
+    def is_lod_character(self, char):
+        if not self.is_lod or char.id == PLAYER_ID or group_times[char.id]:
+            return False
+        plan_data = char.plan_data
+        if plan_data is not None and plan_data.second_character_id:
+            return False
+        return get_lod_settlement_id(char) != self.player_settlement_id
+
+    def get_ms_skipped(self, chars, simulate_to_ms, period_ms, player_wake_ms=None):
+        """
+        Whole periods until the first wake up(or player_wake_ms) if nobody but the player has to be simulated
+        """
+        if any(char.id not in self.dormant for char in chars if char.id != PLAYER_ID):
+            return 0
+        while self.heap and self.dormant.get(self.heap[0][1], (None, None))[1] != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        wake_ms = self.heap[0][0] if self.heap else simulate_to_ms
+        if player_wake_ms is not None:
+            wake_ms = min(wake_ms, player_wake_ms)
+        periods = int((min(wake_ms, simulate_to_ms) - self.period_start_ms) // period_ms)
+        return periods * period_ms if periods > 0 else 0
+
+    def get_player_wake_ms(self, char, ms):
+        """Time the player's plan needs a decision at(with the margin), None if it has to be simulated every period"""
+        wake_seconds = get_wake_seconds(char, ms / 1000, self.player_thresholds)
+        if wake_seconds is None or wake_seconds == float('inf'):
+            return wake_seconds
+        return int(round(wake_seconds * 1000)) - self.wake_margin_ms
+
+    def extend_period(self, period_ms):
+        """The period is stretched over the skipped ones, the player is simulated with it"""
+        self.period_end_ms = self.period_start_ms + period_ms
+
+    def get_behind_ms(self, ms):
+        """The earliest time characters can still be simulated at, dormant ones catch up from their time"""
+        return min([ms] + [since_ms for since_ms, _ in self.dormant.values()])
+
+    def is_dormant(self, char):
+        self.visited.add(char.id)
+        return char.id in self.dormant
+
+    def sleep(self, char, ms):
+        """Makes character dormant since ms(its simulated time) if its next event is far enough"""
+        if self.is_lod_character(char):
+            lod_characters_ids.add(char.id)
+        else:
+            lod_characters_ids.discard(char.id)
+        if char.id == PLAYER_ID:
+            return False
+        wake_ms = get_wake_seconds(char, ms / 1000)
+        if wake_ms is not None and wake_ms != float('inf'):
+            wake_ms = int(round(wake_ms * 1000))
+        if char.id in lod_characters_ids:  # at least one coarse step, events inside it are handled by the catch up
+            wake_ms = max(wake_ms or 0, ms + self.lod_ms + self.wake_margin_ms)
+        if wake_ms is None:
+            return False
+        wake_ms -= self.wake_margin_ms
+        if wake_ms <= ms + self.wake_margin_ms:
+            return False
+        self.dormant[char.id] = (ms, wake_ms)
+        heapq.heappush(self.heap, (wake_ms, char.id))
+        if DEBUG_SIMULATION:
+            logger.info('{} is dormant until {}'.format(char.title, wake_ms / 1000))
+        return True
+
+    def catch_up(self, char, ms):
+        since_ms, _ = self.dormant.pop(char.id)
+        if DEBUG_SIMULATION:
+            logger.info('{} wakes up, {} minutes passed'.format(char.title, round((ms - since_ms) / 60000, 4)))
+        if ms > since_ms:
+            simulate_character(char, ms - since_ms, since_ms)
+
+    def wake(self, char):
+        """Wakes character before the other one changes its plan"""
+        if char is not None and char.id in self.dormant:
+            self.catch_up(char, self.period_end_ms if char.id in self.visited else self.period_start_ms)
+
+    def wake_all(self, ms):
+        for char_id in list(self.dormant):
+            if char_id in self.dormant:  # can be woken by the catch up of its group plan partner
+                self.catch_up(Character(char_id), ms)
+        self.heap = []
@@ -0,0 +1,338 @@
+from __future__ import division
+
+import logging
+import multiprocessing
+
+from kernel.data import classes
+from kernel.models import BaseModel, Character
+from kernel.settings import PLAYER_ID, SHARDS_EPOCH_MINUTES, SHARDS_PROCESSES
+from kernel.simulation.sim import Simulation
+from kernel.state import Fork, apply_rows, clean_caches, get_globals, set_globals
+from kernel.storage import dumps, loads
+from kernel.utils import (
+    from_fixed,
+    get_random_states,
+    group_times,
+    plan_pauses,
+    relations_cache,
+    route_locked_places,
+    set_random_states,
+    shard_characters_ids,
+    stay_until_seconds,
+    to_fixed
+)
+
+logger = logging.getLogger('simulation')
+
+CHARACTER_GLOBALS = (
+    ('group_times', group_times),
+    ('plan_pauses', plan_pauses),
+    ('stay_until_seconds', stay_until_seconds),
+    ('route_locked_places', route_locked_places)
+)
+
+
+def is_delta_field(klass, name, value):
+    """
+    Counters the effects change(gold, population, needs) are merged as increments, so shards can change
+    the same counter, other fields(stages, route progress, states) are overwritten by the last shard
+    """
+    return (
+        klass is not None and
+        name in klass.objects_effects_fields and
+        isinstance(value, (int, float)) and
+        not isinstance(value, bool)
+    )
+
+
+def get_delta(value, value_base):
+    if isinstance(value, int) and isinstance(value_base, int):
+        return value - value_base
+    return from_fixed(to_fixed(value) - to_fixed(value_base))
+
+
+def add_delta(value, delta):
+    if isinstance(value, int) and isinstance(delta, int):
+        return value + delta
+    return from_fixed(to_fixed(value) + to_fixed(delta))
+
+
+def get_fork_diff(fork):
+    """{model name: {pk: (values, deltas, is_new) or None}} of the rows changed inside the fork"""
+    diff = {}
+    for model_name, table in fork.tables.items():
+        klass = classes.get(model_name)
+        rows = {}
+        for pk in table.deleted:
+            rows[pk] = None
+        for pk, row in table.rows.items():
+            base = table.parent.get(pk)
+            if base is None:
+                rows[pk] = (dict(row), {}, True)
+                continue
+            values = {}
+            deltas = {}
+            for k, v in row.items():
+                v_base = base.get(k)
+                if v == v_base:
+                    continue
+                if is_delta_field(klass, k, v) and is_delta_field(klass, k, v_base):
+                    deltas[k] = get_delta(v, v_base)
+                else:
+                    values[k] = v
+            if values or deltas:
+                rows[pk] = (values, deltas, False)
+        if rows:
+            diff[model_name] = rows
+    return diff
+
+
+def get_characters_globals(chars_ids):
+    return {
+        name: {char_id: data[char_id] for char_id in chars_ids if data.get(char_id)}
+        for name, data in CHARACTER_GLOBALS
+    }
+
+
+def get_random_streams_changed(fork):
+    """States of the random streams used inside the fork, streams are per entity so shards don't share them"""
+    states = fork.parent_globals['random_streams']
+    return {k: v for k, v in get_random_states().items() if states.get(k) != v}
+
+
+def set_characters_globals(chars_ids, data):
+    for name, target in CHARACTER_GLOBALS:
+        for char_id in chars_ids:
+            target.pop(char_id, None)
+        for char_id, value in data[name].items():
+            target[char_id] = value
+    states = get_random_states()
+    states.update(data['random_streams'])
+    set_random_states(states)
+
+
+def apply_diff(diff, changed):
+    """Applies diff of the other shard, changed collects keys of the rows to broadcast"""
+    from kernel.data import db
+
+    for model_name, rows in diff.items():
+        objects = db[model_name]['objects']
+        klass = classes.get(model_name)
+        attrs_range = (klass.db_attrs_range or {}) if klass else {}
+        model_changed = changed.setdefault(model_name, set())
+        for pk, data in rows.items():
+            model_changed.add(pk)
+            row = objects.get(pk)
+            if data is None:
+                objects.pop(pk, None)
+            elif row is None:
+                if not data[2]:
+                    raise ValueError('Row "{}" {} changed by the shard was not found'.format(model_name, pk))
+                objects[pk] = dict(data[0])
+            else:
+                values, deltas, is_new = data
+                row = dict(row, **values)  # the row can be the one of the parent fork
+                for k, delta in deltas.items():
+                    value = add_delta(row[k], delta) if row.get(k) is not None else delta
+                    if k in attrs_range:
+                        value = min(max(value, attrs_range[k]['min']), attrs_range[k]['max'])
+                    row[k] = value
+                objects[pk] = row
+                if klass:
+                    klass.set_dirty(pk, list(values) + list(deltas))
+                continue
+            if klass:
+                klass.set_dirty(pk)
+
+
+def get_rows(changed):
+    from kernel.data import db
+
+    data = {}
+    for model_name, pks in changed.items():
+        objects = db[model_name]['objects']
+        data[model_name] = {pk: dict(objects[pk]) if pk in objects else None for pk in pks}
+    return data
+
+
+def get_characters_shards():
+    """
+    {settlement id: characters ids}, characters of one place and group plans are kept in one shard,
+    characters without a place go to the shard of their settlement or to the player's one
+    """
+    places_shards = {}
+    chars_shards = {}
+    chars = sorted(Character.objects.filter(is_clone=False), key=lambda c: c.id)
+    for char in chars:
+        place = char.place
+        if place is None:
+            continue
+        shard = places_shards.get(place.id)
+        if shard is None:
+            shard = place.settlement_id or char.settlement_id
+            places_shards[place.id] = shard
+        chars_shards[char.id] = shard
+    for char in chars:
+        if char.id not in chars_shards:
+            chars_shards[char.id] = char.settlement_id or chars_shards.get(PLAYER_ID)
+    for char in chars:
+        plan_data = char.plan_data
+        if plan_data and plan_data.second_character_id in chars_shards:
+            chars_shards[plan_data.second_character_id] = chars_shards[plan_data.first_character_id]
+
+    shards = {}
+    for char_id, shard in chars_shards.items():
+        shards.setdefault(shard, set()).add(char_id)
+    return shards
+
+
+def get_context():
+    """Workers must inherit the loaded world, so they are forked whatever the platform default is"""
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def set_shard(chars_ids):
+    shard_characters_ids.clear()
+    shard_characters_ids.update(chars_ids)
+
+
+def run_worker(connection, simulation, shard_index, shards_number):
+    BaseModel.pk_step = shards_number
+    BaseModel.pk_offset = shard_index
+    fork = None
+    while True:
+        message = loads(connection.recv_bytes())
+        command = message[0]
+        if command == 'stop':
+            break
+        elif command == 'commit':
+            fork.commit()
+        elif command == 'discard':
+            fork.discard()
+        elif command == 'simulate':
+            chars_ids, seconds_to, rows, globals_data = message[1:]
+            if rows is not None:
+                apply_rows(rows)
+                set_globals(globals_data)
+                relations_cache.clear()
+                clean_caches()
+            fork = Fork()
+            fork.open()
+            set_shard(chars_ids)
+            if chars_ids:
+                simulation.simulate(seconds=seconds_to - simulation.time.seconds)
+            else:
+                simulation.time.add_seconds(seconds_to - simulation.time.seconds)
+            chars_globals = dict(get_characters_globals(chars_ids), random_streams=get_random_streams_changed(fork))
+            connection.send_bytes(dumps((get_fork_diff(fork), chars_globals)))
+    connection.close()
+
+
+class ShardedSimulation(object):
+    """
+    Simulates the characters of different settlements in parallel processes.
+
+    Characters are split by the settlement of their place every epoch, the player's shard is simulated
+    in this process, others in the forked workers. At the end of every epoch the workers send the changed rows,
+    they are merged here(counters as increments, other fields by the last shard) and broadcast with the next epoch.
+    Characters of different shards see each other with the delay of an epoch. Linux only(workers are forked
+    with the loaded world).
+    """
+
+    def __init__(self, simulation=None, processes=SHARDS_PROCESSES, epoch_minutes=SHARDS_EPOCH_MINUTES):
+        self.simulation = simulation or Simulation()
+        self.processes = processes or multiprocessing.cpu_count()
+        self.epoch_seconds = epoch_minutes * 60
+        self.workers = []
+        self.context = get_context()
+
+    def start_workers(self, number):
+        for shard_index in range(1, number + 1):
+            connection, connection_worker = self.context.Pipe()
+            process = self.context.Process(
+                target=run_worker, args=(connection_worker, self.simulation, shard_index, number + 1)
+            )
+            process.daemon = True
+            process.start()
+            self.workers.append((process, connection))
+        BaseModel.pk_step = number + 1
+        BaseModel.pk_offset = 0
+
+    def stop_workers(self):
+        for process, connection in self.workers:
+            connection.send_bytes(dumps(('stop',)))
+            process.join()
+        self.workers = []
+        BaseModel.pk_step = 1
+        BaseModel.pk_offset = 0
+
+    def send(self, connection, *message):
+        connection.send_bytes(dumps(message))
+
+    def get_workers_shards(self, shards):
+        """Parent shard(player's one) and characters of every worker"""
+        player_shard = None
+        for shard, chars_ids in shards.items():
+            if PLAYER_ID in chars_ids:
+                player_shard = shard
+        workers_chars = [set() for _ in self.workers]
+        for inx, shard in enumerate(sorted(s for s in shards if s != player_shard)):
+            workers_chars[inx % len(self.workers)].update(shards[shard])
+        return shards.get(player_shard, {PLAYER_ID}), workers_chars
+
+    def simulate_epoch(self, seconds_to, rows):
+        parent_chars, workers_chars = self.get_workers_shards(get_characters_shards())
+        globals_data = dict(get_globals(), relations_cache={}) if rows is not None else None
+        for (process, connection), chars_ids in zip(self.workers, workers_chars):
+            self.send(connection, 'simulate', chars_ids, seconds_to, rows, globals_data)
+
+        fork = Fork()
+        fork.open()
+        set_shard(parent_chars)
+        self.simulation.simulate(seconds=seconds_to - self.simulation.time.seconds)
+        parent_diff = get_fork_diff(fork)
+        fork.commit()
+
+        seconds_simulated = self.simulation.time.seconds
+        results = [loads(connection.recv_bytes()) for process, connection in self.workers]
+        if seconds_simulated < seconds_to:  # player broke the simulation, workers redo the shorter epoch
+            for process, connection in self.workers:
+                self.send(connection, 'discard')
+            for (process, connection), chars_ids in zip(self.workers, workers_chars):
+                self.send(connection, 'simulate', chars_ids, seconds_simulated, None, None)
+            results = [loads(connection.recv_bytes()) for process, connection in self.workers]
+        for process, connection in self.workers:
+            self.send(connection, 'commit')
+
+        changed = {model_name: set(diff_rows) for model_name, diff_rows in parent_diff.items()}
+        for chars_ids, (diff, chars_globals) in zip(workers_chars, results):
+            apply_diff(diff, changed)
+            set_characters_globals(chars_ids, chars_globals)
+        relations_cache.clear()
+        clean_caches()
+        return seconds_simulated == seconds_to, get_rows(changed)
+
+    def simulate(self, **time_kwargs):
+        simulation = self.simulation
+        shards_number = len(get_characters_shards())
+        if shards_number < 2 or self.processes < 2:
+            simulation.simulate(**time_kwargs)
+            return
+
+        from datetime import timedelta
+
+        seconds_to = simulation.time.seconds + timedelta(**time_kwargs or {'minutes': 99999}).total_seconds()
+        self.start_workers(min(self.processes, shards_number) - 1)
+        rows = None
+        try:
+            while simulation.time.seconds < seconds_to:
+                is_finished, rows = self.simulate_epoch(
+                    min(simulation.time.seconds + self.epoch_seconds, seconds_to), rows
+                )
+                if not is_finished:
+                    break
+        finally:
+            self.stop_workers()
+            set_shard(())
@@ -6,156 +6,295 @@ from datetime import timedelta
 
 from kernel import renpy
 from kernel.models import Character, Plan, Settlement
-from kernel.settings import DEBUG_SIMULATION, DEBUG_ORM, PLAYER_ID, START_DT, SIMULATE_PERIOD
+from kernel.profiler import perf_counter, timers
+from kernel.settings import (
+    DEBUG_SIMULATION,
+    DEBUG_ORM,
+    PLAYER_ID,
+    START_DT,
+    SIMULATE_LOD,
+    SIMULATE_PERIOD,
+    SIMULATE_SCHEDULER
+)
 from kernel.simulation.base import SimulationPeriod
 from kernel.simulation.plans.apply import get_and_set_plan, set_plan
-from kernel.utils import group_times, player_data
+from kernel.simulation.plans.create import get_plans
+from kernel.simulation.scheduler import Scheduler
+from kernel.utils import (
+    get_random_states, group_times, plan_pauses, player_data, set_random_states, shard_characters_ids,
+    simulation_stats
+)
 
 logger_simulation = logging.getLogger('simulation')
 logger_orm = logging.getLogger('orm')
 
 
 class Time(object):
+    """Game clock in integer milliseconds since the midnight of the start day, datetime is built for display only"""
+
     def __init__(self, start_dt):
+        self.day_start_dt = start_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        self.ms = 0
         self.dt = start_dt
-        self.seconds = start_dt.hour * 3600 + start_dt.minute * 60 + start_dt.second
+
+    @property
+    def dt(self):
+        return self.day_start_dt + timedelta(milliseconds=self.ms)
+
+    @dt.setter
+    def dt(self, dt):
+        delta = dt - self.day_start_dt
+        self.ms = (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+    @property
+    def seconds(self):
+        return self.ms / 1000
+
+    @seconds.setter
+    def seconds(self, seconds):
+        self.ms = int(round(seconds * 1000))
 
     def add_seconds(self, seconds):
-        self.dt += timedelta(seconds=seconds)
-        self.seconds += seconds
+        self.ms += int(round(seconds * 1000))
 
     def get_day_seconds(self):
-        return self.dt.hour * 3600 + self.dt.minute * 60 + self.dt.second
+        return self.ms // 1000 % 86400
 
 
 class Simulation(object):
     time = Time(START_DT)
+    seconds_left = 0
+    is_scheduler = SIMULATE_SCHEDULER
+    is_lod = SIMULATE_LOD
 
     def __init__(self):
         for s in Settlement.objects.filter():
             s.set_positions()
 
-    def simulate(self, **time_kwargs):
-        simulate_to_seconds = self.time.seconds + timedelta(**time_kwargs or {'minutes': 99999}).total_seconds()
-        period_seconds = SIMULATE_PERIOD.total_seconds()
-        period_minutes = round(period_seconds / 60, 2)
+    def simulate(self, budget_ms=None, is_adaptive=False, **time_kwargs):
+        """
+        Returns the simulated seconds. With budget_ms it stops at the end of the period the budget ran out in,
+        self.seconds_left is the time left then: simulate(seconds=simulation.seconds_left) continues
+        with the same scheduler, dormant characters are woken when the interval is done.
+        is_adaptive lowers the detail of the characters far from the player when the budget is tight.
+        """
+        ms_start = self.time.ms
+        for _ in self.simulate_steps(budget_ms=budget_ms, is_adaptive=is_adaptive, **time_kwargs):
+            pass
+        return (self.time.ms - ms_start) / 1000
+
+    def simulate_steps(self, chars_per_step=None, ms_per_step=None, budget_ms=None, is_adaptive=False, **time_kwargs):
+        """
+        Resumable simulate(), yields the progress(0..1) every chars_per_step simulated characters or ms_per_step
+        milliseconds, at the end of every period if none of them is set. The world must not be changed
+        until the generator is exhausted.
+        """
+        ms_start = self.time.ms
+        time_start = perf_counter()
+        self.seconds_left = 0
+        simulate_to_ms = ms_start + int(round(timedelta(**time_kwargs or {'minutes': 99999}).total_seconds() * 1000))
+        is_step_period = not chars_per_step and not ms_per_step
+        step_chars = 0
+        step_start = perf_counter()
+        period_ms = int(SIMULATE_PERIOD.total_seconds() * 1000)
+        period_minutes = round(period_ms / 60000, 2)
+        period_ms_normal = None
         player = Character(PLAYER_ID)
         initial_plan_data = player.plan_data
         chars = [player]
         chars.extend(Character.objects.filter(is_clone=False, id__ne=PLAYER_ID))
-
-        while self.time.seconds < simulate_to_seconds:
-            if DEBUG_SIMULATION:
-                logger_simulation.info(
-                    '{} {}({}) {}'.format('*' * 10, self.time.dt, self.time.seconds, '*' * 10)
-                )
-                for s in Settlement.objects.filter():
-                    logger_simulation.info('{}:, g: {}'.format(s.title, s.gold))
-
-            if self.time.seconds + period_seconds >= simulate_to_seconds:
-                if initial_plan_data and player.plan_data and player.plan_data is not initial_plan_data:
-                    simulate_to_seconds += period_seconds + group_times[PLAYER_ID] * 60
-                if self.time.seconds + period_seconds > simulate_to_seconds:
-                    period_seconds = (simulate_to_seconds * 1000 - self.time.seconds * 1000) / 1000
-                    period_minutes = round(period_seconds / 60, 2)
-
-            for char in chars:
-                if DEBUG_SIMULATION:
-                    plan_data = char.plan_data
-                    if plan_data:
-                        first_character = plan_data.first_character
-                        second_character = plan_data.second_character
-                        plan_desc_items = [plan_data.plan.title]
-                        if second_character is not None:
-                            plan_desc_items.append('({})'.format(
-                                second_character.title if first_character.id == char.id else first_character.title
+        if shard_characters_ids:
+            chars = [char for char in chars if char.id in shard_characters_ids]
+        scheduler = Scheduler.current  # the interval stopped by the budget goes on with the same scheduler
+        if scheduler and not self.is_scheduler:
+            scheduler.finish(self.time.ms)
+            scheduler = None
+        elif scheduler is None and self.is_scheduler:
+            scheduler = Scheduler.start(self.is_lod)
+        is_suspended = False
+        try:
+            while self.time.ms < simulate_to_ms:
+                if budget_ms and self.time.ms > ms_start:
+                    ms_spent = (perf_counter() - time_start) * 1000
+                    if ms_spent >= budget_ms:
+                        self.seconds_left = (simulate_to_ms - self.time.ms) / 1000
+                        is_suspended = True
+                        if DEBUG_SIMULATION:
+                            logger_simulation.info('budget {} ms is spent, {} seconds left'.format(
+                                budget_ms, self.seconds_left
                             ))
-                        plan_desc = ''.join(plan_desc_items)
-                    else:
-                        plan_desc = 'no plan'
+                        break
+                    if is_adaptive and scheduler:
+                        ms_per_game_ms = ms_spent / (self.time.ms - ms_start)
+                        if ms_per_game_ms * (simulate_to_ms - self.time.ms) > budget_ms - ms_spent:
+                            scheduler.lower_detail(self.time.ms)
+                if DEBUG_SIMULATION:
                     logger_simulation.info(
-                        '--- {}({}, {}, g: {}, e: {}, sl: {}, h: {})'.format(
-                            char.title.upper(),
-                            char.place.title,
-                            plan_desc,
-                            int(char.gold),
-                            int(char.energy),
-                            int(char.sleep),
-                            int(char.health),
-                        )
+                        '{} {}({}) {}'.format('*' * 10, self.time.dt, self.time.seconds, '*' * 10)
                     )
+                    for s in Settlement.objects.filter():
+                        logger_simulation.info('{}:, g: {}'.format(s.title, s.gold))
 
-                time_passed = 0
-                current_seconds = self.time.seconds
-                current_day_seconds = self.time.get_day_seconds()
-                minutes_left = period_minutes
-
-                group_time_passed = group_times[char.id]
-                if group_time_passed:
-                    if group_time_passed > period_minutes:
-                        group_times[char.id] = group_time_passed - period_minutes
-                        group_time_passed = period_minutes
-                    else:
-                        group_times[char.id] = 0
-                    current_seconds += group_time_passed * 60
-                    current_day_seconds += group_time_passed * 60
-                    if current_day_seconds > 86400:
-                        current_day_seconds = current_day_seconds - 86400
-                    minutes_left = (minutes_left * 1000 - group_time_passed * 1000) / 1000
-                    if not minutes_left:
-                        time_passed = None
-                    if DEBUG_SIMULATION:
-                        logger_simulation.info('group time passed: {}'.format(group_time_passed))
-
-                while time_passed is not None:
-                    plan_data = char.plan_data
-                    if char.id == PLAYER_ID:
-                        if char.health < 101:
-                            renpy.exports.say(None, "Lost health.")
-                            renpy.exports.jump('game_over')
-                            return
-                        if char.energy < 101 and (not plan_data or plan_data.plan.title != 'fainting'):
-                            set_plan(Plan.objects.get(title='fainting'), char, current_seconds, is_break=True)
-                            plan_data = char.plan_data
-                            player_data['is_restart_simulation'] = True
-                        if not plan_data and not initial_plan_data:
-                            time_passed = None
+                if self.time.ms + period_ms >= simulate_to_ms:
+                    if initial_plan_data and player.plan_data and player.plan_data is not initial_plan_data:
+                        simulate_to_ms += period_ms + int(round(group_times[PLAYER_ID] * 60000))
+                    if self.time.ms + period_ms > simulate_to_ms:
+                        period_ms = simulate_to_ms - self.time.ms
+                        period_minutes = round(period_ms / 60000, 2)
+
+                if timers.is_enabled:
+                    timers.set_tick(self.time.seconds)
+                if scheduler:
+                    scheduler.start_period(self.time.ms, period_ms)
+                    is_player_idle = not initial_plan_data and not player.plan_data
+                    player_wake_ms = scheduler.get_player_wake_ms(player, self.time.ms) if player.plan_data else None
+                    if is_player_idle or player_wake_ms is not None:
+                        ms_skipped = scheduler.get_ms_skipped(chars, simulate_to_ms, period_ms, player_wake_ms)
+                        if ms_skipped and DEBUG_SIMULATION:
+                            logger_simulation.info('fast forward {} seconds'.format(ms_skipped / 1000))
+                        if ms_skipped and is_player_idle:
+                            self.time.ms += ms_skipped
                             continue
-                        if (not plan_data and initial_plan_data) or player_data['is_break_simulation']:
-                            player_data['is_break_simulation'] = False
-                            if not (plan_data and plan_data.plan.is_encounter):  # noqa
-                                simulate_to_seconds = current_seconds
-                                period_minutes = round(period_minutes - minutes_left, 2)
-                                period_seconds = period_minutes * 60
-                            break
-                    elif plan_data is None:
-                        get_and_set_plan(current_seconds, current_day_seconds, char)
+                        if ms_skipped > period_ms:  # the player's plan goes on with one long period
+                            period_ms_normal = period_ms
+                            period_ms = ms_skipped
+                            period_minutes = round(period_ms / 60000, 2)
+                            scheduler.extend_period(period_ms)
+                plan_pauses.purge(scheduler.get_behind_ms(self.time.ms) / 1000 if scheduler else self.time.seconds)
+                chars_idle = [
+                    char for char in chars
+                    if char.id != PLAYER_ID and char.plan_data is None and not group_times[char.id] and
+                    not (scheduler and char.id in scheduler.dormant)
+                ]
+                plans_chosen = {}
+                if len(chars_idle) > 1:  # everybody picks a plan at once(start, group plans ended)
+                    plans_chosen = get_plans(chars_idle, self.time.seconds, self.time.get_day_seconds())
+                for char in chars:
+                    if scheduler and scheduler.is_dormant(char):
                         continue
-                    time_passed = SimulationPeriod(
-                        char, period_minutes, minutes_left, current_seconds, current_day_seconds
-                    ).simulate()
-                    if not time_passed:
-                        continue
-                    if time_passed < 0:
-                        raise ValueError('time_passed: {} less then zero'.format(time_passed))
-                    elif time_passed > period_minutes:
-                        raise ValueError('time_passed: {} > period_minutes: {}'.format(time_passed, period_minutes))
+                    if timers.is_enabled:
+                        timers.set_character(char.id)
                     if DEBUG_SIMULATION:
-                        logger_simulation.info('time passed: {}'.format(round(time_passed, 2)))
-                    current_seconds += time_passed * 60
-                    current_day_seconds += time_passed * 60
-                    if current_day_seconds > 86400:
-                        current_day_seconds = current_day_seconds - 86400
-                    minutes_left = (minutes_left * 1000 - time_passed * 1000) / 1000
-
-            if period_seconds:
-                self.time.add_seconds(period_seconds)
-            if player_data['is_restart_simulation']:
-                player_data['is_restart_simulation'] = False
-                period_seconds = SIMULATE_PERIOD.total_seconds()
-                period_minutes = round(period_seconds / 60, 2)
-                simulate_to_seconds += period_seconds
+                        plan_data = char.plan_data
+                        if plan_data:
+                            first_character = plan_data.first_character
+                            second_character = plan_data.second_character
+                            plan_desc_items = [plan_data.plan.title]
+                            if second_character is not None:
+                                plan_desc_items.append('({})'.format(
+                                    second_character.title if first_character.id == char.id else first_character.title
+                                ))
+                            plan_desc = ''.join(plan_desc_items)
+                        else:
+                            plan_desc = 'no plan'
+                        logger_simulation.info(
+                            '--- {}({}, {}, g: {}, e: {}, sl: {}, h: {})'.format(
+                                char.title.upper(),
+                                char.place.title,
+                                plan_desc,
+                                int(char.gold),
+                                int(char.energy),
+                                int(char.sleep),
+                                int(char.health),
+                            )
+                        )
 
+                    time_passed = 0
+                    current_ms = self.time.ms
+                    current_seconds = current_ms / 1000
+                    current_day_seconds = current_ms % 86400000 / 1000
+                    period_minutes_ms = int(round(period_minutes * 60000))
+                    passed_ms = 0
+                    minutes_left = period_minutes
+
+                    group_time_passed = group_times[char.id]
+                    if group_time_passed:
+                        if group_time_passed > period_minutes:
+                            group_times[char.id] = group_time_passed - period_minutes
+                            group_time_passed = period_minutes
+                        else:
+                            group_times[char.id] = 0
+                        passed_ms = int(round(group_time_passed * 60000))
+                        current_ms += passed_ms
+                        current_seconds = current_ms / 1000
+                        current_day_seconds = current_ms % 86400000 / 1000
+                        minutes_left = (period_minutes_ms - passed_ms) / 60000
+                        if not minutes_left:
+                            time_passed = None
+                        if DEBUG_SIMULATION:
+                            logger_simulation.info('group time passed: {}'.format(group_time_passed))
+
+                    plan_choice = plans_chosen.pop(char.id, None)  # made for the start of the period only
+                    while time_passed is not None:
+                        plan_data = char.plan_data
+                        if char.id == PLAYER_ID:
+                            if char.health < 101:
+                                renpy.exports.say(None, "Lost health.")
+                                renpy.exports.jump('game_over')
+                                return
+                            if char.energy < 101 and (not plan_data or plan_data.plan.title != 'fainting'):
+                                set_plan(Plan.objects.get(title='fainting'), char, current_seconds, is_break=True)
+                                plan_data = char.plan_data
+                                player_data['is_restart_simulation'] = True
+                            if not plan_data and not initial_plan_data:
+                                time_passed = None
+                                continue
+                            if (not plan_data and initial_plan_data) or player_data['is_break_simulation']:
+                                player_data['is_break_simulation'] = False
+                                if not (plan_data and plan_data.plan.is_encounter):  # noqa
+                                    simulate_to_ms = current_ms
+                                    period_ms = passed_ms
+                                    period_minutes = round(period_ms / 60000, 2)
+                                break
+                        elif plan_data is None:
+                            get_and_set_plan(current_seconds, current_day_seconds, char, plan_choice=plan_choice)
+                            plan_choice = None
+                            continue
+                        time_passed = SimulationPeriod(
+                            char, period_minutes, minutes_left, current_seconds, current_day_seconds
+                        ).simulate()
+                        if not time_passed:
+                            continue
+                        if time_passed < 0:
+                            raise ValueError('time_passed: {} less then zero'.format(time_passed))
+                        elif time_passed > period_minutes:
+                            raise ValueError('time_passed: {} > period_minutes: {}'.format(time_passed, period_minutes))
+                        if DEBUG_SIMULATION:
+                            logger_simulation.info('time passed: {}'.format(round(time_passed, 2)))
+                        time_passed_ms = int(round(time_passed * 60000))
+                        passed_ms += time_passed_ms
+                        current_ms += time_passed_ms
+                        current_seconds = current_ms / 1000
+                        current_day_seconds = current_ms % 86400000 / 1000
+                        minutes_left = (period_minutes_ms - passed_ms) / 60000
+
+                    if scheduler:
+                        scheduler.sleep(char, self.time.ms + period_ms)
+                    step_chars += 1
+                    if (
+                        (chars_per_step and step_chars >= chars_per_step) or
+                        (ms_per_step and (perf_counter() - step_start) * 1000 >= ms_per_step)
+                    ):
+                        yield self.get_progress(ms_start, simulate_to_ms)
+                        step_chars = 0
+                        step_start = perf_counter()
+
+                self.time.ms += period_ms
+                simulation_stats['periods'] += 1
+                if period_ms_normal:
+                    period_ms = period_ms_normal
+                    period_minutes = round(period_ms / 60000, 2)
+                    period_ms_normal = None
+                if player_data['is_restart_simulation']:
+                    player_data['is_restart_simulation'] = False
+                    period_ms = int(SIMULATE_PERIOD.total_seconds() * 1000)
+                    period_minutes = round(period_ms / 60000, 2)
+                    simulate_to_ms += period_ms
+                if is_step_period and self.time.ms < simulate_to_ms:
+                    yield self.get_progress(ms_start, simulate_to_ms)
+        finally:  # an exception or a closed generator must not leave the characters dormant
+            if scheduler and not is_suspended:
+                scheduler.finish(self.time.ms)
         if DEBUG_SIMULATION:
             logger_simulation.info('{} {}({}) {}'.format('*' * 10, self.time.dt, self.time.seconds, '*' * 10))
         if DEBUG_ORM:
@@ -164,3 +303,44 @@ class Simulation(object):
             called_times = sorted(called_times.items(), key=lambda v: sum(v[1]), reverse=True)
             for row in called_times:
                 logger_orm.info(row)
+        yield 1.0
+
+    def get_progress(self, ms_start, simulate_to_ms):
+        if simulate_to_ms <= ms_start:
+            return 1.0
+        return min((self.time.ms - ms_start) / (simulate_to_ms - ms_start), 1.0)
+
+    def verify_fast_forward(self, tolerance=1, **time_kwargs):
+        """
+        Simulates the same time from the current state step-wise and with the scheduler(without LOD) in forks,
+        returns {char id: {attr: (step-wise value, scheduler value)}} for attributes that differ more than tolerance.
+        """
+        from kernel.state import Fork
+
+        random_states = get_random_states()
+        results = []
+        self.is_lod = False
+        try:
+            for is_scheduler in (False, True):
+                set_random_states(random_states)
+                self.is_scheduler = is_scheduler
+                with Fork():
+                    self.simulate(**time_kwargs)
+                    results.append({
+                        char.id: {k: getattr(char, k) for k in char.objects_effects_fields}
+                        for char in Character.objects.filter(is_clone=False)
+                    })
+        finally:
+            self.__dict__.pop('is_scheduler', None)
+            self.__dict__.pop('is_lod', None)
+
+        diffs = {}
+        for char_id, values in results[0].items():
+            values_scheduler = results[1].get(char_id, {})
+            for k, v in values.items():
+                v_scheduler = values_scheduler.get(k)
+                if v == v_scheduler:
+                    continue
+                if v is None or v_scheduler is None or abs(v - v_scheduler) > tolerance:
+                    diffs.setdefault(char_id, {})[k] = (v, v_scheduler)
+        return diffs
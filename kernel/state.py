@@ -0,0 +1,412 @@
+import io
+import os
+import pickle
+import uuid
+
+from kernel import BASE_DIR
+from kernel.data import classes, db
+from kernel.models import BaseModel
+from kernel.settings import JOURNAL_COMPACT_RECORDS
+from kernel.simulation.scheduler import Scheduler
+from kernel.simulation.sim import Simulation
+from kernel.storage import dump, load
+from kernel.utils import (
+    compiled_filters,
+    compiled_mods,
+    dirty_rows,
+    get_random_states,
+    group_times,
+    modifiers_results,
+    plan_pauses,
+    plans_eligibility,
+    player_data,
+    qs_cache,
+    qs_cache_relations,
+    relations_cache,
+    route_locked_places,
+    set_random_states,
+    stay_until_seconds,
+    world_seed
+)
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+def get_tables():
+    return {
+        model_name: klass.db_objects if klass.db_objects.__class__ is dict else dict(klass.db_objects.items())
+        for model_name, klass in classes.items()
+    }
+
+
+def get_dirty_rows():
+    data = {}
+    for model_name, model_dirty in dirty_rows.items():
+        if not model_dirty:
+            continue
+        objects = classes[model_name].db_objects
+        rows = {}
+        for pk, fields in model_dirty.items():
+            row = objects.get(pk)
+            if row is None:
+                rows[pk] = None
+            elif fields is None:
+                rows[pk] = dict(row)
+            else:
+                rows[pk] = {k: row[k] for k in fields}
+        data[model_name] = rows
+    return data
+
+
+def apply_rows(data):
+    for model_name, rows in data.items():
+        objects = classes[model_name].db_objects
+        for pk, fields in rows.items():
+            if fields is None:
+                objects.pop(pk, None)
+            elif pk in objects:
+                row = objects[pk]
+                row.update(fields)
+                objects[pk] = row
+            else:
+                objects[pk] = fields
+
+
+def set_tables(tables):
+    for model_name, rows in tables.items():
+        objects = classes[model_name].db_objects
+        objects.clear()
+        objects.update(rows)
+
+
+def get_globals():
+    return {
+        'group_times': dict(group_times),
+        'plan_pauses': {k: dict(v) for k, v in plan_pauses.items() if v},
+        'stay_until_seconds': dict(stay_until_seconds),
+        'route_locked_places': {k: set(v) for k, v in route_locked_places.items() if v},
+        'relations_cache': dict(relations_cache),
+        'player_data': dict(player_data),
+        'random_streams': get_random_states(),
+        'world_seed': world_seed[0],
+        'time': Simulation.time.ms
+    }
+
+
+def set_globals(data):
+    for name, target in (
+        ('group_times', group_times),
+        ('stay_until_seconds', stay_until_seconds),
+        ('relations_cache', relations_cache),
+        ('player_data', player_data)
+    ):
+        target.clear()
+        target.update(data[name])
+    plan_pauses.clear()
+    plan_pauses.update(data['plan_pauses'])
+    route_locked_places.clear()
+    route_locked_places.update(data['route_locked_places'])
+    set_random_states(data.get('random_streams', {}))
+    world_seed[0] = data.get('world_seed', world_seed[0])
+    Simulation.time.ms = data['time']
+
+
+def clean_caches():
+    qs_cache.clear()
+    qs_cache_relations.clear()
+    plans_eligibility.clear()
+    modifiers_results.clear()
+    compiled_filters.clear()
+    compiled_mods.clear()
+    BaseModel.refresh_instances()
+
+
+def finish_scheduler():
+    """Wakes the characters left dormant by a budget stop, so the rows are up to the clock"""
+    if Scheduler.current is not None:
+        Scheduler.current.finish(Simulation.time.ms)
+
+
+def snapshot():
+    """Full simulation state(tables, simulation globals and time) as a binary blob"""
+    finish_scheduler()
+    f = io.BytesIO()
+    dump((get_tables(), get_globals()), f)
+    return f.getvalue()
+
+
+def restore(data):
+    tables, globals_data = load(io.BytesIO(data))
+    Scheduler.drop()
+    set_tables(tables)
+    set_globals(globals_data)
+    dirty_rows.clear()
+    clean_caches()
+    Journal.restores += 1
+
+
+class Journal(object):
+    """
+    Incremental save: every save() appends only the rows and the globals entries changed since the previous one,
+    every `compact_records` saves the journal is folded into a full snapshot.
+    The journal starts with the id of the snapshot it continues, records of an older snapshot(a crash
+    between the snapshot replace and the journal truncation) are skipped on load.
+    """
+    restores = 0
+    entries_globals = (
+        'group_times', 'plan_pauses', 'stay_until_seconds', 'route_locked_places', 'relations_cache', 'random_streams'
+    )  # journaled by the changed entries, the other globals are small and written whole
+
+    def __init__(self, path=None, compact_records=JOURNAL_COMPACT_RECORDS):
+        self.path = path or os.path.join(BASE_DIR, 'simulation.journal')
+        self.snapshot_path = '{}.snapshot'.format(self.path)
+        self.compact_records = compact_records
+        self.records = 0
+        self.restores = Journal.restores
+        self.globals = None
+        self.snapshot_id = None
+
+    def get_globals_diff(self, globals_old, globals_new):
+        diff = {}
+        for name, value in globals_new.items():
+            if name not in self.entries_globals:
+                diff[name] = value
+                continue
+            value_old = globals_old[name]
+            if value == value_old:
+                continue
+            diff[name] = (
+                {k: v for k, v in value.items() if k not in value_old or value_old[k] != v},
+                [k for k in value_old if k not in value]
+            )
+        return diff
+
+    def apply_globals_diff(self, globals_data, diff):
+        for name, value in diff.items():
+            if name not in self.entries_globals:
+                globals_data[name] = value
+                continue
+            entries, removed = value
+            target = globals_data[name]
+            target.update(entries)
+            for k in removed:
+                target.pop(k, None)
+
+    def save(self):
+        finish_scheduler()
+        if self.globals is None or not os.path.isfile(self.snapshot_path) or self.restores != Journal.restores:
+            self.compact()
+            return True
+        rows = get_dirty_rows()
+        dirty_rows.clear()
+        globals_data = get_globals()
+        globals_diff = self.get_globals_diff(self.globals, globals_data)
+        self.globals = globals_data
+        with open(self.path, 'ab') as f:
+            dump({'rows': rows, 'globals': globals_diff}, f)
+        self.records += 1
+        if self.compact_records and self.records >= self.compact_records:
+            self.compact()
+        return True
+
+    def compact(self):
+        snapshot_path_tmp = '{}.tmp'.format(self.snapshot_path)
+        tables, self.globals = get_tables(), get_globals()
+        self.snapshot_id = uuid.uuid4().hex
+        with open(snapshot_path_tmp, 'wb') as f:
+            dump((tables, self.globals, self.snapshot_id), f)
+        if os.name == 'nt' and os.path.isfile(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        os.rename(snapshot_path_tmp, self.snapshot_path)
+        self.reset_journal()
+        dirty_rows.clear()
+        self.restores = Journal.restores
+
+    def reset_journal(self):
+        with open(self.path, 'wb') as f:
+            dump({'snapshot_id': self.snapshot_id}, f)
+        self.records = 0
+
+    def load(self):
+        if not os.path.isfile(self.snapshot_path):
+            return False
+        with open(self.snapshot_path, 'rb') as f:
+            tables, globals_data, self.snapshot_id = load(f)
+        Scheduler.drop()
+        set_tables(tables)
+        self.records = 0
+        is_current = False
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                try:
+                    is_current = load(f).get('snapshot_id') == self.snapshot_id
+                except (EOFError, pickle.UnpicklingError):
+                    pass
+                while is_current:
+                    try:
+                        data = load(f)
+                    except (EOFError, pickle.UnpicklingError):  # the last record can be cut by a crash
+                        break
+                    apply_rows(data['rows'])
+                    self.apply_globals_diff(globals_data, data['globals'])
+                    self.records += 1
+        if not is_current:  # the journal of the previous snapshot, its compaction was cut by a crash
+            self.reset_journal()
+        set_globals(globals_data)
+        self.globals = get_globals()
+        Journal.restores += 1
+        dirty_rows.clear()
+        clean_caches()
+        self.restores = Journal.restores
+        return True
+
+
+class CowTable(MutableMapping):
+    """Table of a fork, rows are shared with the parent table until the first write"""
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.rows = {}
+        self.deleted = set()
+
+    def __getitem__(self, pk):
+        if pk in self.rows:
+            return self.rows[pk]
+        if pk in self.deleted:
+            raise KeyError(pk)
+        return self.parent[pk]
+
+    def __setitem__(self, pk, row):
+        self.rows[pk] = row
+        self.deleted.discard(pk)
+
+    def __delitem__(self, pk):
+        if pk not in self:
+            raise KeyError(pk)
+        self.rows.pop(pk, None)
+        if pk in self.parent:
+            self.deleted.add(pk)
+
+    def __contains__(self, pk):
+        if pk in self.rows:
+            return True
+        return pk not in self.deleted and pk in self.parent
+
+    def __iter__(self):
+        for pk in self.parent:
+            if pk not in self.deleted:
+                yield pk
+        for pk in self.rows:
+            if pk not in self.parent:
+                yield pk
+
+    def __len__(self):
+        return len(self.parent) - len(self.deleted) + len([pk for pk in self.rows if pk not in self.parent])
+
+    def get_writable(self, pk):
+        row = self.rows.get(pk)
+        if row is None:
+            row = dict(self[pk])
+            self.rows[pk] = row
+        return row
+
+    def commit(self):
+        parent = self.parent
+        for pk in self.deleted:
+            parent.pop(pk, None)
+        for pk, row in self.rows.items():
+            if parent.__class__ is dict and pk in parent:
+                parent[pk].clear()  # keep the row object, parent instances refer to it
+                parent[pk].update(row)
+            else:
+                parent[pk] = row
+
+
+class Fork(object):
+    """
+    Copy-on-write view of the world for lookahead:
+
+        with Fork() as fork:
+            simulation.simulate(hours=2)
+            fork.commit()  # otherwise discarded on exit
+
+    Rows are shared with the parent until written, instances and caches are separate,
+    so instances taken before the fork must not be used inside it.
+    """
+
+    def __init__(self):
+        self.tables = None
+        self.parent_tables = None
+        self.parent_instances = None
+        self.parent_globals = None
+        self.parent_dirty_rows = None
+        self.parent_qs_cache = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.is_open():
+            self.discard()
+
+    def is_open(self):
+        return self.tables is not None
+
+    def open(self):
+        if self.is_open():
+            raise ValueError('Fork is already open')
+        finish_scheduler()
+        self.parent_tables = {name: data['objects'] for name, data in db.items()}
+        self.tables = {name: CowTable(objects) for name, objects in self.parent_tables.items()}
+        self.set_tables(self.tables)
+        self.parent_instances = BaseModel.swap_instances({})
+        self.parent_globals = get_globals()
+        self.parent_dirty_rows = {k: dict(v) for k, v in dirty_rows.items()}
+        self.parent_qs_cache = (dict(qs_cache), dict(qs_cache_relations))
+        dirty_rows.clear()
+        qs_cache.clear()
+        qs_cache_relations.clear()
+        relations_cache.clear()
+
+    @staticmethod
+    def set_tables(tables):
+        for name, objects in tables.items():
+            db[name]['objects'] = objects
+            if name in classes:
+                classes[name].db_objects = objects
+
+    def close(self):
+        self.set_tables(self.parent_tables)
+        BaseModel.swap_instances(self.parent_instances)
+        self.tables = None
+
+    def discard(self):
+        Scheduler.drop()
+        self.close()
+        set_globals(self.parent_globals)
+        dirty_rows.clear()
+        dirty_rows.update(self.parent_dirty_rows)
+        qs_cache.clear()
+        qs_cache_relations.clear()
+        qs_cache.update(self.parent_qs_cache[0])
+        qs_cache_relations.update(self.parent_qs_cache[1])
+        plans_eligibility.clear()  # rows are back, versions are not
+        modifiers_results.clear()
+        BaseModel.refresh_instances()  # instances of the parent could be touched inside the fork
+
+    def commit(self):
+        for table in self.tables.values():
+            table.commit()
+        self.close()
+        for model_name, model_dirty in self.parent_dirty_rows.items():
+            for pk, fields in model_dirty.items():
+                if fields is None:
+                    classes[model_name].set_dirty(pk)
+                else:
+                    classes[model_name].set_dirty(pk, fields)
+        relations_cache.clear()
+        clean_caches()
@@ -0,0 +1,369 @@
+import io
+import pickle
+import re
+import sqlite3
+import sys
+
+from collections import OrderedDict
+from kernel.models import BaseModel
+from kernel.orm import QuerySet
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+if sys.version_info[0] >= 3:
+    SCALAR_TYPES = (int, float, str, bool)
+    BLOB_TYPES = (bytes,)
+else:
+    SCALAR_TYPES = (int, long, float, str, unicode, bool)  # noqa
+    BLOB_TYPES = (buffer, bytes)  # noqa
+
+PICKLE_PROTOCOL = 2
+
+
+class RowsPickler(pickle.Pickler):
+    """Rows can hold model instances(e.g. Route.places), they are stored as references"""
+
+    def persistent_id(self, obj):
+        if isinstance(obj, BaseModel):
+            return obj.__class__.__name__, obj.pk
+        return None
+
+
+class RowsUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        from kernel.data import classes
+
+        model_name, pk = pid
+        klass = classes[model_name]
+        instance = klass.__new__(klass, pk)
+        if pk in klass.db_objects:  # rows decoded by a storage table, otherwise by refresh_instances after a restore
+            instance.__init__(pk)
+        return instance
+
+
+def dump(data, f):
+    RowsPickler(f, PICKLE_PROTOCOL).dump(data)
+
+
+def load(f):
+    return RowsUnpickler(f).load()
+
+
+def dumps(data):
+    f = io.BytesIO()
+    dump(data, f)
+    return f.getvalue()
+
+
+def loads(data):
+    return load(io.BytesIO(data))
+
+
+class NotTranslated(Exception):
+    pass
+
+
+def quote(name):
+    return '"{}"'.format(name)
+
+
+def is_scalar(value):
+    return value is None or isinstance(value, SCALAR_TYPES)
+
+
+class SqlFilter(object):
+    """Translates QuerySet lookups into a WHERE clause"""
+
+    def __init__(self, table, filters):
+        self.table = table
+        self.filters = filters
+        self.params = []
+        self.aliases = 0
+
+    def get_alias(self):
+        self.aliases += 1
+        return 't{}'.format(self.aliases)
+
+    def get_condition(self, column, cmd, value):
+        if cmd in ('in', 'nin'):
+            if isinstance(value, (str, bytes)) or not hasattr(value, '__iter__'):
+                raise NotTranslated
+            values = list(value)
+            is_none = None in values
+            values = [v for v in values if v is not None]
+            if not all(is_scalar(v) for v in values):
+                raise NotTranslated
+            self.params.extend(values)
+            values_sql = '{} IN ({})'.format(column, ', '.join('?' * len(values))) if values else None
+            if cmd == 'in':
+                items = [values_sql] if values_sql else []
+                if is_none:
+                    items.append('{} IS NULL'.format(column))
+                return '({})'.format(' OR '.join(items)) if items else '0'
+            if is_none:
+                return '({} IS NOT NULL AND NOT {})'.format(column, values_sql) if values_sql else '{} IS NOT NULL'.format(
+                    column
+                )
+            return '({} IS NULL OR NOT {})'.format(column, values_sql) if values_sql else '1'
+        if cmd == 'isnull':
+            return '{} IS {}NULL'.format(column, '' if value else 'NOT ')
+        if not is_scalar(value):
+            raise NotTranslated
+        operator = {'exact': 'IS', 'ne': 'IS NOT', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}.get(cmd)
+        if operator is None:
+            raise ValueError('Cmd: "{}" not found'.format(cmd))
+        self.params.append(value)
+        return '{} {} ?'.format(column, operator)
+
+    def get_lookup_sql(self, relations, field_name, cmd, value):
+        if not relations:
+            self.table.add_index(field_name)
+            return self.get_condition('t0.{}'.format(quote(field_name)), cmd, value)
+
+        joins = []
+        wheres = []
+        model_data = self.table.model_data
+        prev_alias = 't0'
+        relations_number = len(relations)
+        table_name = None
+        for inx, relation in enumerate(relations, start=1):
+            alias = self.get_alias()
+            if relation in (model_data['mto_data'] or {}):
+                relation_data = model_data['mto_data'][relation]
+                model_data = relation_data['model'].db_data
+                table_name = model_data['name']
+                wheres.append('{}.id = {}.{}'.format(alias, prev_alias, quote(relation_data['from_id'])))
+            elif relation in (model_data['mtm_data'] or {}):
+                relation_data = model_data['mtm_data'][relation]
+                through_data = relation_data['through']
+                through_alias = self.get_alias()
+                joins.append('{} {}'.format(quote(through_data['name']), through_alias))
+                wheres.append('{}.{} = {}.id'.format(through_alias, quote(relation_data['from_id']), prev_alias))
+                if (
+                    relations_number == inx and
+                    field_name != 'id' and
+                    field_name in through_data['objects_fields']
+                ):
+                    alias = through_alias
+                    model_data = through_data
+                    table_name = None
+                else:
+                    model_data = relation_data['model'].db_data
+                    table_name = model_data['name']
+                    wheres.append('{}.id = {}.{}'.format(alias, through_alias, quote(relation_data['target_id'])))
+            elif relation.endswith('_set'):
+                relation_data = model_data['set_data'][relation]
+                model_data = relation_data['model'].db_data
+                table_name = model_data['name']
+                wheres.append('{}.{} = {}.id'.format(alias, quote(relation_data['target_id']), prev_alias))
+            else:
+                raise ValueError('Relation not found')
+            if table_name is not None:
+                joins.append('{} {}'.format(quote(table_name), alias))
+            prev_alias = alias
+
+        wheres.append(self.get_condition('{}.{}'.format(prev_alias, quote(field_name)), cmd, value))
+        return 'EXISTS (SELECT 1 FROM {} WHERE {})'.format(', '.join(joins), ' AND '.join(wheres))
+
+    def get_sql(self):
+        items = []
+        groups = OrderedDict()
+        for lookup, value in self.filters.items():
+            regex = re.search(r'__or([0-9])?(a)?([0-9])?$', lookup) if '__or' in lookup else None
+            if regex:
+                lookup = lookup.rsplit('__', 1)[0]
+            relations, field_name, cmd = QuerySet.parse_filter(lookup)
+            if not field_name:
+                raise ValueError('Empty lookup')
+            self.params = []
+            item = (self.get_lookup_sql(relations, field_name, cmd, value), self.params)
+            if not regex:
+                items.append(item)
+                continue
+            group = groups.setdefault(regex.group(1) or '1', OrderedDict())
+            if regex.group(2):
+                group.setdefault('and{}'.format(regex.group(3) or '1'), []).append(item)
+            else:
+                group[len(group)] = [item]
+
+        for group in groups.values():
+            items.append((
+                '({})'.format(' OR '.join('({})'.format(' AND '.join(sql for sql, _ in v)) for v in group.values())),
+                [param for v in group.values() for _, params in v for param in params]
+            ))
+        self.params = [param for _, params in items for param in params]
+        return ' AND '.join(sql for sql, _ in items)
+
+
+class SqliteTable(MutableMapping):
+    """
+    Model table kept in SQLite with a cache of the recently used rows, the file is seeded from the model data
+    once and opened as is by the next runs
+    """
+    IN_CHUNK = 500  # below the default limit of the query parameters
+
+    def __init__(self, connection, model_data, cache_rows=10000):
+        self.connection = connection
+        self.model_data = model_data
+        self.name = model_data['name']
+        self.name_quoted = quote(self.name)
+        self.cache = OrderedDict()
+        self.cache_rows = cache_rows
+        self.indexes = set()
+
+        objects = model_data['objects']
+        defaults = model_data['defaults'] or {}
+        self.bool_fields = {k for k, v in defaults.items() if isinstance(v, bool)}
+        for row in objects.values():
+            self.bool_fields.update(k for k, v in row.items() if isinstance(v, bool))
+        self.fields = [row[1] for row in self.connection.execute('PRAGMA table_info({})'.format(self.name_quoted))]
+        is_seeded = bool(self.fields)  # the table of the previous runs is opened as is
+        if not is_seeded:
+            self.fields = list(model_data['objects_fields'])
+            for row in objects.values():
+                self.fields.extend(k for k in row if k not in self.fields)
+            self.connection.execute('CREATE TABLE {} ({})'.format(self.name_quoted, ', '.join(
+                'id INTEGER PRIMARY KEY' if k == 'id' else quote(k) for k in self.fields
+            )))
+        for field_name in model_data['objects_fields']:
+            if field_name not in self.fields:  # added to the model after the file was created
+                self.connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(self.name_quoted, quote(field_name)))
+                self.fields.append(field_name)
+        for field_name in self.fields:
+            if field_name.endswith('_id'):
+                self.add_index(field_name)
+        self.id_index = self.fields.index('id')
+        self.select_sql = 'SELECT {} FROM {}'.format(', '.join(quote(k) for k in self.fields), self.name_quoted)
+        self.insert_sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            self.name_quoted, ', '.join(quote(k) for k in self.fields), ', '.join('?' * len(self.fields))
+        )
+        if not is_seeded:
+            self.connection.executemany(self.insert_sql, [self.encode(row) for row in objects.values()])
+
+    def add_index(self, field_name):
+        if field_name in self.indexes or field_name == 'id' or field_name not in self.fields:
+            return
+        self.connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            quote('{}_{}'.format(self.name, field_name)), self.name_quoted, quote(field_name)
+        ))
+        self.indexes.add(field_name)
+
+    def encode(self, row):
+        return [v if is_scalar(v) else sqlite3.Binary(dumps(v)) for v in (row.get(k) for k in self.fields)]
+
+    def decode(self, values):
+        row = {}
+        for field_name, value in zip(self.fields, values):
+            if isinstance(value, BLOB_TYPES):
+                value = loads(bytes(value))
+            elif value is not None and field_name in self.bool_fields:
+                value = bool(value)
+            row[field_name] = value
+        return row
+
+    def set_cache(self, pk, row):
+        self.cache[pk] = row
+        if len(self.cache) > self.cache_rows:
+            self.cache.popitem(last=False)
+
+    def __getitem__(self, pk):
+        row = self.cache.pop(pk, None)
+        if row is None:
+            values = self.connection.execute('{} WHERE id = ?'.format(self.select_sql), (pk,)).fetchone()
+            if values is None:
+                raise KeyError(pk)
+            row = self.decode(values)
+        self.set_cache(pk, row)
+        return row
+
+    def __setitem__(self, pk, row):
+        row['id'] = pk
+        self.connection.execute(self.insert_sql, self.encode(row))
+        self.cache.pop(pk, None)
+        self.set_cache(pk, row)
+
+    def __delitem__(self, pk):
+        if pk not in self:
+            raise KeyError(pk)
+        self.connection.execute('DELETE FROM {} WHERE id = ?'.format(self.name_quoted), (pk,))
+        self.cache.pop(pk, None)
+
+    def __contains__(self, pk):
+        if pk in self.cache:
+            return True
+        return self.connection.execute(
+            'SELECT 1 FROM {} WHERE id = ?'.format(self.name_quoted), (pk,)
+        ).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.connection.execute(
+            'SELECT id FROM {} ORDER BY id'.format(self.name_quoted)
+        )])
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM {}'.format(self.name_quoted)).fetchone()[0]
+
+    def clear(self):
+        self.connection.execute('DELETE FROM {}'.format(self.name_quoted))
+        self.cache.clear()
+
+    def get_writable(self, pk):
+        return self[pk]
+
+    def get_rows(self, pks=None):
+        """
+        {pk: row} of the pks(all rows by id if None) read in one query per IN_CHUNK pks, cached rows are taken
+        from the cache, the read ones are not cached, so a scan doesn't evict the used rows
+        """
+        cache = self.cache
+        id_index = self.id_index
+        rows = OrderedDict()
+        if pks is None:
+            for values in self.connection.execute('{} ORDER BY id'.format(self.select_sql)):
+                pk = values[id_index]
+                row = cache.get(pk)
+                rows[pk] = row if row is not None else self.decode(values)
+            return rows
+        pks_missing = [pk for pk in pks if pk not in cache]
+        rows_read = {}
+        for inx in range(0, len(pks_missing), self.IN_CHUNK):
+            pks_chunk = pks_missing[inx:inx + self.IN_CHUNK]
+            for values in self.connection.execute(
+                '{} WHERE id IN ({})'.format(self.select_sql, ', '.join('?' * len(pks_chunk))), pks_chunk
+            ):
+                rows_read[values[id_index]] = self.decode(values)
+        for pk in pks:
+            row = cache.get(pk)
+            if row is None:
+                row = rows_read.get(pk)
+            if row is not None:
+                rows[pk] = row
+        return rows
+
+    def items(self):
+        return self.get_rows().items()
+
+    def values(self):
+        return self.get_rows().values()
+
+    def select_pks(self, filters, is_first_only=False):
+        """Returns None if filters can't be translated to SQL, the caller filters the rows then"""
+        sql_filter = SqlFilter(self, filters)
+        try:
+            where = sql_filter.get_sql()
+        except NotTranslated:
+            return None
+        sql = 'SELECT t0.id FROM {} t0 WHERE {} ORDER BY t0.id'.format(self.name_quoted, where)
+        if is_first_only:
+            sql += ' LIMIT 1'
+        return [row[0] for row in self.connection.execute(sql, sql_filter.params)]
+
+
+def get_connection(path):
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('PRAGMA journal_mode = MEMORY')
+    return connection
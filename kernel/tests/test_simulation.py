@@ -1,17 +1,58 @@
 from __future__ import print_function
 
+import json
+import copy
 import os
+import random
+import re
 import sys
+import tempfile
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 import time
 from io import StringIO
 
-from kernel.models import Character, Plan, PlanData
-from kernel.settings import PLAYER_ID
+from kernel import run
+from kernel.data import db
+from kernel.models import (
+    BaseModel, Character, CharacterDataFilters, EventLog, Place, Plan, PlanData, PlanPlaceFilters, Stage
+)
+from kernel.profiler import timers
+from kernel.settings import MODIFIERS_CACHE_SIZE, PLAYER_ID, SIMULATE_PERIOD
+from kernel.simulation.plans.apply import set_plan
+from kernel.simulation.plans.create import (
+    GetPlan, WeightedSampler, get_plans, get_plans_filters, get_plans_time_index
+)
+from kernel.simulation.plans.modifiers import CharacterPlanModifiers, PlanModifiers
+from kernel.simulation.scheduler import Scheduler
+from kernel.simulation.shards import ShardedSimulation, apply_diff, get_characters_shards
 from kernel.simulation.sim import Simulation
-from kernel import profiler
+from kernel.state import Fork, Journal, clean_caches, restore, snapshot
+from kernel.storage import SqliteTable, dumps, get_connection, loads
+from kernel.utils import (
+    FIXED_SCALE,
+    PlanPauses,
+    ReplacementText,
+    compiled_filters,
+    compiled_mods,
+    fixed_multiply,
+    from_fixed,
+    get_compiled_filters,
+    get_filters_replaced,
+    get_random,
+    get_random_states,
+    get_text_replaced,
+    get_value_replaced,
+    get_value_replaced_second_char,
+    is_in_time_range,
+    modifiers_results,
+    random_streams,
+    set_random_states,
+    simulation_stats,
+    to_fixed,
+    unicode
+)
 
 
 def timer(func):
@@ -20,8 +61,9 @@ def timer(func):
         func(*args, **kwargs)
         print("Tests took {} seconds to complete".format(round(time.time() - start, 2)))
         sio = StringIO()
-        profiler.print_stats(sio, output_unit=1e-03)
+        timers.print_stats(sio)
         print(sio.getvalue())
+        timers.reset()
     return wrapper
 
 
@@ -50,7 +92,383 @@ def test_simulation_player_plan_group():
     simulation.simulate()
 
 
+@timer
+def test_snapshot_restore():
+    data = snapshot()
+    seconds = simulation.time.seconds
+    sleep = player.sleep
+    simulation.simulate(minutes=60)
+    restore(data)
+    assert simulation.time.seconds == seconds
+    assert player.sleep == sleep
+    assert snapshot() == data
+    assert not compiled_filters and not compiled_mods
+
+
+@timer
+def test_journal():
+    path = os.path.join(tempfile.mkdtemp(), 'simulation.journal')
+    journal = Journal(path)
+    journal.save()
+    for _ in range(2):
+        simulation.simulate(minutes=30)
+        journal.save()
+    data = snapshot()
+    simulation.simulate(minutes=30)
+    journal.save()
+    with open(path, 'rb+') as f:
+        f.truncate(os.path.getsize(path) - 10)  # the last record is cut by a crash
+    simulation.simulate(minutes=30)
+    assert Journal(path).load()
+    assert loads(snapshot()) == loads(data)  # rows can share objects, so the bytes differ
+
+
+@timer
+def test_journal_compact_crash():
+    path = os.path.join(tempfile.mkdtemp(), 'simulation.journal')
+    journal = Journal(path, compact_records=0)
+    journal.save()
+    simulation.simulate(minutes=30)
+    journal.save()
+    with open(path, 'rb') as f:
+        records = f.read()
+    simulation.simulate(minutes=30)
+    journal.compact()
+    data = snapshot()
+    with open(path, 'wb') as f:
+        f.write(records)  # the crash came after the snapshot replace, before the journal truncation
+    simulation.simulate(minutes=30)
+    assert Journal(path).load()
+    assert loads(snapshot()) == loads(data)
+
+
+@timer
+def test_sqlite_storage():
+    data = snapshot()
+    simulation.simulate(hours=2)
+    data_simulated = snapshot()
+    restore(data)
+    connection = get_connection(os.path.join(tempfile.mkdtemp(), 'simulation.sqlite3'))
+    tables = {name: model_data['objects'] for name, model_data in db.items()}
+    Fork.set_tables({
+        name: SqliteTable(connection, model_data, cache_rows=20) for name, model_data in db.items()
+    })
+    instances = BaseModel.swap_instances({})
+    clean_caches()
+    try:
+        simulation.simulate(hours=2)
+        assert loads(snapshot()) == loads(data_simulated)  # the same world as with the memory tables
+        table = Character.db_objects
+        assert len(table.cache) <= 20
+        player.update(gold=player.gold + 1)
+        table.cache.clear()  # evicted rows are read back from the file
+        assert table[PLAYER_ID]['gold'] == player.gold
+        table_reopened = SqliteTable(connection, dict(db['Character'], objects={}))  # not seeded again
+        assert len(table_reopened) == len(tables['Character']) and table_reopened[PLAYER_ID]['gold'] == player.gold
+    finally:
+        Fork.set_tables(tables)
+        BaseModel.swap_instances(instances)
+        restore(data_simulated)
+
+
+@timer
+def test_fork():
+    seconds = simulation.time.seconds
+    rows = {pk: dict(row) for pk, row in Character.db_objects.items()}
+    with Fork():
+        simulation.simulate(minutes=60)
+    assert simulation.time.seconds == seconds
+    assert {pk: dict(row) for pk, row in Character.db_objects.items()} == rows
+    with Fork() as fork:
+        simulation.simulate(minutes=60)
+        seconds = simulation.time.seconds
+        rows = {pk: dict(row) for pk, row in Character.db_objects.items()}
+        fork.commit()
+    assert simulation.time.seconds == seconds
+    assert {pk: dict(row) for pk, row in Character.db_objects.items()} == rows
+    assert player.sleep == rows[PLAYER_ID]['sleep']
+
+
+@timer
+def test_random_streams():
+    with Fork():
+        char = player.clone()
+        pk = char.id
+        get_random('Character', pk).random()
+        char.delete()
+        assert ('Character', pk) not in random_streams
+        assert get_random('Character', pk).words == 0  # a reused pk starts a new stream
+
+
+@timer
+def test_fixed_point():
+    for char in Character.objects.filter(is_clone=False):  # the simulated attributes stay on the grid
+        assert all(from_fixed(to_fixed(getattr(char, k))) == getattr(char, k) for k in char.objects_effects_fields)
+    value = 1000
+    for _ in range(100000):  # a week of 0.007 decrements per 6 seconds doesn't accumulate the float error
+        value = from_fixed(to_fixed(value) + to_fixed(-0.007))
+    assert value == 300
+    rng = random.Random(0)
+    for _ in range(10000):  # a product is off by half a grid step at most, 0.72 over 72 hours of periods
+        v, mod = rng.uniform(-10, 10), rng.uniform(0, 20)
+        assert abs(fixed_multiply(v, mod) - v * mod) <= .5 / FIXED_SCALE + 1e-9
+
+
+@timer
+def test_plans_batch():
+    with Fork():
+        chars = [char for char in Character.objects.filter(is_clone=False) if char.id != PLAYER_ID]
+        for char in chars:
+            char.update(plan_data=None)
+        random_states = get_random_states()
+        plans = get_plans(chars, simulation.time.seconds, simulation.time.get_day_seconds())
+        set_random_states(random_states)
+        assert plans == get_plans(chars, simulation.time.seconds, simulation.time.get_day_seconds())
+        taken_ids = list(plans) + [
+            second.id for plan, second, second_plan_data_id in plans.values() if second and plan.filters.is_group
+        ]
+        assert len(taken_ids) == len(set(taken_ids))  # a partner is taken by one character only
+
+
+def get_filters_replaced_uncompiled(filters, char, second_char=None):
+    filters_new = {}
+    for filter_k, filter_v in filters.items():
+        if isinstance(filter_v, (str, unicode)):
+            filters_new[filter_k] = get_value_replaced_second_char(filter_v, char, second_char)
+        elif isinstance(filter_v, list):
+            filters_new[filter_k] = [
+                get_value_replaced_second_char(v, char, second_char) if isinstance(v, (str, unicode)) else v
+                for v in filter_v
+            ]
+        else:
+            filters_new[filter_k] = filter_v
+    return filters_new
+
+
+@timer
+def test_compiled_caches():
+    char_other = next(char for char in Character.objects.filter(is_clone=False) if char.id != PLAYER_ID)
+    templates = [row.filters for row in CharacterDataFilters.objects.filter()]
+    templates.extend(row.filters for row in PlanPlaceFilters.objects.filter())
+    for filters in templates:
+        replaced = get_filters_replaced_uncompiled(filters, player, char_other)
+        assert get_filters_replaced(filters, player, char_other) == replaced
+        assert get_compiled_filters(copy.deepcopy(filters)) is get_compiled_filters(filters)  # a decoded row
+    for row in CharacterDataFilters.objects.filter():
+        for points_mods in (row.acceptance_points_base, row.plan_points_mods):
+            compiled = CharacterPlanModifiers(player, points_mods, char_other).get_compiled()
+            assert CharacterPlanModifiers(player, copy.deepcopy(points_mods), char_other).get_compiled() is compiled
+
+    modifiers_results.update((k, None) for k in range(MODIFIERS_CACHE_SIZE))
+    PlanModifiers(player, {'exact': 'energy'}).get()
+    assert len(modifiers_results) == 1  # the full cache was dropped
+
+
+@timer
+def test_plan_stages():
+    assert [Plan.get_stage_index(name) for name in Plan.stages_names] == list(range(len(Plan.stages_names)))
+    assert Plan.get_stage_index(2) == 2
+    assert isinstance(PlanData.defaults['plan_stage'], int)
+    assert all(isinstance(row['plan_stage'], int) for row in PlanData.db_objects.values())
+    with Fork():
+        plan_data = PlanData.create(plan=Plan.objects.get(title='sleep'), plan_stage=0, first_character=player)
+        indexes = [plan_data.plan_stage]
+        while plan_data.next_stage():
+            indexes.append(plan_data.plan_stage)
+        assert indexes == [0, 1] and plan_data.plan_stage == 1  # the last stage is kept
+        stage = Stage.create()
+        stage.is_filter_stage = True  # its filters were deleted
+        assert not Plan.compile_stage(stage, None).is_finished_in_time
+
+
+def get_text_formatted(text, instance):
+    return text.format(**{name: get_value_replaced(instance, name) for name in re.findall(r'{(.*?)}', text)})
+
+
+@timer
+def test_texts():
+    logs = EventLog.objects.filter().instances
+    assert logs
+    assert EventLog.get_descriptions(logs) == [get_text_formatted(log.plan.event_desc, log) for log in logs]
+    char_other = next(char for char in Character.objects.filter(is_clone=False) if char.id != PLAYER_ID)
+    replacement = ReplacementText(player, char_other, player.place)
+    for plan in Plan.objects.filter():
+        for text in (plan.event_desc, plan.ask_player_desc, plan.beginning_text):
+            if text:
+                assert get_text_replaced(text, replacement) == get_text_formatted(text, replacement)
+    text = '{_first_character__title!r:>12} {_place__title!s}, {_second_character__title!a}'
+    assert get_text_replaced(text, replacement) == '{!r:>12} {!s}, {!r}'.format(
+        player.title, player.place.title, char_other.title
+    )
+
+
+@timer
+def test_plans_time_index():
+    filters = get_plans_filters()
+    plans = Plan.objects.filter(**filters).instances
+    buckets = get_plans_time_index(filters)
+    for minute in range(0, 1440, 7):
+        for seconds in (minute * 60, minute * 60 + 59):
+            expected = {plan.id for plan in plans if not plan.filters or is_in_time_range(seconds, plan.filters)}
+            assert {
+                plan.id for plan in buckets[minute] if not plan.filters or is_in_time_range(seconds, plan.filters)
+            } == expected
+
+
+@timer
+def test_plans_eligibility():
+    with Fork():
+        get_plan = GetPlan(simulation.time.seconds, simulation.time.get_day_seconds(), player)
+        plans = [plan for plan in Plan.objects.filter() if plan.filters and plan.filters.first_character]
+        for sleep in (200, 900, 200):  # the cached results are dropped when the filtered field is changed
+            player.update(sleep=sleep)
+            for plan in plans * 2:
+                filters = plan.filters.first_character.filters
+                expected = bool(Character.objects.filter(id=player.id, **get_filters_replaced(filters, player)))
+                assert get_plan.is_first_char_eligible(plan, filters) == expected
+
+
+@timer
+def test_plan_pauses():
+    pauses = PlanPauses({1: {10: 100, 11: -1}})
+    pauses.set(1, 12, 50)
+    pauses.set(2, 10, 70)
+    pauses.set(1, 12, 300)  # prolonged, the old expiry stays in the heap
+    assert pauses.get_paused(1, 60) == {10, 11, 12}
+    pauses.purge(100)
+    assert pauses == {1: {11: -1, 12: 300}}
+    assert pauses.get_paused(1, 100) == {11, 12}
+    for pauses in (pauses, loads(dumps(pauses))):  # the loaded registry rebuilds its heap
+        pauses.purge(10 ** 6)
+        assert pauses == {1: {11: -1}} and not pauses.heap
+
+
+@timer
+def test_weighted_sampler():
+    rng = random.Random(1)
+    for _ in range(200):
+        population = [rng.uniform(100, 1000) for _ in range(rng.randint(1, 12))]
+        sampler = WeightedSampler(population)
+        seed = rng.random()
+        rng_sampler, rng_choices = random.Random(seed), random.Random(seed)
+        for _ in range(20):  # the same draws as random.choices
+            assert sampler.choice(rng_sampler) == rng_choices.choices(population, population)[0]
+    assert WeightedSampler(['a', 'b'], [0, 1]).choice(rng) == 'b'
+
+
+@timer
+def test_fast_forward():
+    assert not simulation.verify_fast_forward(hours=8)
+    with Fork():
+        player.update(sleep=200, place=Place.objects.get(title='player_camelot_bedroom'))
+        set_plan(Plan.objects.get(title='sleep'), player, simulation.time.seconds)
+        assert not simulation.verify_fast_forward(hours=8)  # the player's plan bounds the dormancy
+        periods = simulation_stats['periods']
+        assert simulation.simulate(hours=8) == 8 * 3600
+        assert simulation_stats['periods'] - periods < 8 * 3600 / SIMULATE_PERIOD.total_seconds()
+
+
+@timer
+def test_simulate_steps():
+    results = []
+    for steps_kwargs in ({'chars_per_step': 1}, {'ms_per_step': 1}, {}):
+        with Fork():
+            progress = list(simulation.simulate_steps(hours=4, **steps_kwargs))
+            assert progress and progress[-1] == 1.0
+            results.append({pk: dict(row) for pk, row in Character.db_objects.items()})
+    with Fork():
+        simulation.simulate(hours=4)
+        assert all(rows == {pk: dict(row) for pk, row in Character.db_objects.items()} for rows in results)
+    with Fork():
+        steps = simulation.simulate_steps(hours=4, chars_per_step=1)
+        next(steps)
+        steps.close()
+        assert Scheduler.current is None
+
+
+@timer
+def test_batch_run():
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    try:
+        run.main([
+            '--days', '0.25', '--seeds', '2', '--seed-start', '3', '--processes', '1', '--output', path, '--verbose'
+        ])
+        with open(path) as f:
+            results = sorted((json.loads(line) for line in f), key=lambda r: r['seed'])
+    finally:
+        os.remove(path)
+    assert [r['seed'] for r in results] == [3, 4]
+    for result in results:
+        assert result['seconds_simulated'] == 0.25 * 86400
+        assert 0 < result['ticks'] <= 0.25 * 86400 / SIMULATE_PERIOD.total_seconds()
+        assert result['characters'] == len(Character.objects.filter(is_clone=False).instances)
+        assert set(result['stats']) == set(Character.objects_effects_fields)
+        assert all(result[k] is not None for k in ('wall_time', 'ticks_per_second', 'plans_started'))
+
+
+@timer
+def test_budget():
+    with Fork():
+        seconds = simulation.simulate(budget_ms=1, hours=8)
+        scheduler = Scheduler.current
+        while simulation.seconds_left:
+            assert Scheduler.current is scheduler  # the continuations keep the dormant characters
+            seconds += simulation.simulate(budget_ms=1, is_adaptive=True, seconds=simulation.seconds_left)
+        assert seconds == 8 * 3600
+        assert Scheduler.current is None
+
+
+@timer
+def test_sharded_simulation():
+    with Fork():
+        char = next(c for c in Character.objects.filter(is_clone=False) if c.id != PLAYER_ID)
+        char.update(place=None)
+        shards_chars_ids = set().union(*get_characters_shards().values())
+        assert shards_chars_ids == {c.id for c in Character.objects.filter(is_clone=False)}
+        try:
+            apply_diff({'Character': {-1: ({'gold': 1}, {}, False)}}, {})
+            assert False, 'a changed row missing here is not an insert'
+        except ValueError:
+            pass
+
+    rows = {pk: dict(row) for pk, row in Character.db_objects.items()}
+    with Fork():
+        ShardedSimulation(simulation, processes=2).simulate(hours=2)
+    assert rows == {pk: dict(row) for pk, row in Character.db_objects.items()}  # the merge doesn't leak the fork
+
+    seconds = simulation.time.seconds
+    ShardedSimulation(simulation, processes=2).simulate(hours=12)  # long enough for the plans stages to change
+    assert simulation.time.seconds == seconds + 12 * 3600
+    for char in Character.objects.filter(is_clone=False):
+        plan_data = char.plan_data
+        assert plan_data is None or char.id in (plan_data.first_character_id, plan_data.second_character_id)
+        assert plan_data is None or plan_data.get_stage_record()
+        assert isinstance(char.gold, int)
+
+
 if __name__ == '__main__':
+    timers.enable()
     player = Character(PLAYER_ID)
     simulation = Simulation()
     test_simulation()
+    test_snapshot_restore()
+    test_journal()
+    test_journal_compact_crash()
+    test_sqlite_storage()
+    test_fork()
+    test_random_streams()
+    test_fixed_point()
+    test_plans_batch()
+    test_compiled_caches()
+    test_plan_stages()
+    test_texts()
+    test_plans_time_index()
+    test_plans_eligibility()
+    test_plan_pauses()
+    test_weighted_sampler()
+    test_fast_forward()
+    test_simulate_steps()
+    test_batch_run()
+    test_budget()
+    test_sharded_simulation()
@@ -1,14 +1,87 @@
 from __future__ import division
 
 import ctypes
+import heapq
 import logging
+import random
+import re
+import string
 import time
 import sys
 
 from collections import defaultdict
+from kernel.settings import WORLD_SEED
+
+
+class PlanPauses(dict):
+    """
+    {char id: {plan id: seconds until, -1 is forever}} of the paused plans with a min-heap of the expiries,
+    purge() removes the expired pauses in bulk
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.heap = []
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, char_id, pauses):
+        pauses = dict(pauses)
+        dict.__setitem__(self, char_id, pauses)
+        for plan_id, seconds_until in pauses.items():
+            self.push(char_id, plan_id, seconds_until)
+
+    def update(self, *args, **kwargs):
+        for char_id, pauses in dict(*args, **kwargs).items():
+            self[char_id] = pauses
+
+    def __reduce__(self):  # the heap is built again from the pauses
+        return self.__class__, (dict(self),)
+
+    def clear(self):
+        dict.clear(self)
+        del self.heap[:]
+
+    def push(self, char_id, plan_id, seconds_until):
+        if seconds_until and seconds_until != -1:
+            heapq.heappush(self.heap, (seconds_until, char_id, plan_id))
+
+    def set(self, char_id, plan_id, seconds_until):
+        pauses = self.get(char_id)
+        if pauses is None:
+            pauses = {}
+            dict.__setitem__(self, char_id, pauses)
+        pauses[plan_id] = seconds_until
+        self.push(char_id, plan_id, seconds_until)
+
+    def remove(self, char_id, plan_id):
+        pauses = self.get(char_id)
+        if pauses:
+            pauses.pop(plan_id, None)
+            if not pauses:
+                del self[char_id]
+
+    def get_paused(self, char_id, current_seconds):
+        """Ids of the plans paused for the character at the time"""
+        pauses = self.get(char_id)
+        if not pauses:
+            return set()
+        return {
+            plan_id for plan_id, seconds_until in pauses.items()
+            if seconds_until == -1 or seconds_until > current_seconds
+        }
+
+    def purge(self, seconds):
+        """Removes pauses expired by the time, nobody can be simulated before it anymore"""
+        heap = self.heap
+        while heap and heap[0][0] <= seconds:
+            seconds_until, char_id, plan_id = heapq.heappop(heap)
+            pauses = self.get(char_id)
+            if pauses and pauses.get(plan_id) == seconds_until:
+                self.remove(char_id, plan_id)
+
 
 group_times = defaultdict(int)
-plan_pauses = defaultdict(lambda: defaultdict(int))
+plan_pauses = PlanPauses()
 stay_until_seconds = defaultdict(int)
 route_locked_places = defaultdict(set)
 qs_cache = defaultdict(dict)
@@ -18,8 +91,21 @@ qs_stat = defaultdict(list)
 called_qs_cache = defaultdict(int)
 called_caches_types = defaultdict(int)
 called_qs = defaultdict(int)
+simulation_stats = defaultdict(int)
 player_data = defaultdict(list)
 relations_cache = {}
+dirty_rows = defaultdict(dict)
+fields_versions = defaultdict(int)  # (model name, pk, field), (model name, pk) and model name: number of changes
+plans_eligibility = {}
+modifiers_results = {}
+compiled_mods = {}
+compiled_filters = {}
+compiled_texts = {}
+shard_characters_ids = set()
+lod_characters_ids = set()
+random_streams = {}
+FIXED_SCALE = 1000  # attributes and effects are kept on the 1/1000 grid, sums are done in integers
+world_seed = [WORLD_SEED]
 
 
 logger_simulation = logging.getLogger('simulation')
@@ -102,6 +188,57 @@ def get_value_replaced(instance, name):
     return name
 
 
+def get_compiled_text(text):
+    """
+    Text template parsed once into (literal, attributes chain or name, conversion, format spec) segments,
+    None if it has fields str.format resolves differently({a.b}, {0}, nested specs)
+    """
+    compiled = compiled_texts.get(text)
+    if compiled is not None or text in compiled_texts:
+        return compiled
+    compiled = []
+    for literal, name, format_spec, conversion in string.Formatter().parse(text):
+        if name is None:
+            compiled.append((literal, None, None, None))
+            continue
+        if not name or '.' in name or '[' in name or name.isdigit() or '{' in (format_spec or ''):
+            compiled = None
+            break
+        chain = tuple(name[1:].split('__')) if name.startswith('_') else name
+        compiled.append((literal, chain, conversion, format_spec))
+    compiled_texts[text] = compiled
+    return compiled
+
+
+def get_text_replaced(text, instance):
+    """text.format() with the placeholders(_first_character__first_name) replaced by the values of the instance"""
+    return get_compiled_text_replaced(text, get_compiled_text(text), instance)
+
+
+def get_compiled_text_replaced(text, compiled, instance):
+    if compiled is None:
+        return text.format(**{name: get_value_replaced(instance, name) for name in re.findall(r'{(.*?)}', text)})
+    parts = []
+    for literal, chain, conversion, format_spec in compiled:
+        parts.append(literal)
+        if chain is None:
+            continue
+        if isinstance(chain, tuple):
+            value = instance
+            for name in chain:
+                value = getattr(value, name)
+        else:
+            value = chain
+        if conversion == 'r':
+            value = repr(value)
+        elif conversion == 's':
+            value = str(value)
+        elif conversion == 'a':
+            value = repr(value)
+        parts.append(format(value, format_spec))
+    return ''.join(parts)
+
+
 def get_value_replaced_second_char(name, first, second=None):
     if name.startswith('_'):
         if name.startswith('_second_char'):
@@ -110,20 +247,67 @@ def get_value_replaced_second_char(name, first, second=None):
     return name
 
 
+def compile_value(value):
+    """Constant or getter(is second character, attributes chain) of the placeholder"""
+    if not isinstance(value, (str, unicode)) or not value.startswith('_'):
+        return False, value
+    if value.startswith('_second_char'):
+        return True, (True, tuple(value[13:].split('__')))
+    return True, (False, tuple(value[1:].split('__')))
+
+
+def get_compiled_filters(filters):
+    """
+    Filters template compiled once into (lookups, [(lookup, is list, is getter, value or getter)]),
+    keyed by the template text, so the rows decoded again share it
+    """
+    key = str(filters)
+    compiled = compiled_filters.get(key)
+    if compiled is not None:
+        return compiled
+    items = []
+    for lookup, value in filters.items():
+        if isinstance(value, list):
+            items.append((lookup, True, None, [compile_value(v) for v in value]))
+        else:
+            is_getter, value = compile_value(value)
+            items.append((lookup, False, is_getter, value))
+    compiled = (tuple(filters), items)
+    compiled_filters[key] = compiled
+    return compiled
+
+
+def get_compiled_value(is_getter, value, char, second_char):
+    if not is_getter:
+        return value
+    is_second, names = value
+    instance = second_char if is_second else char
+    for name in names:
+        instance = getattr(instance, name)
+    return instance
+
+
+def get_filters_values(filters, char, second_char=None):
+    """Values of the filters for the characters, lists are tuples"""
+    return tuple(
+        tuple(get_compiled_value(is_getter, v, char, second_char) for is_getter, v in value) if is_list else
+        get_compiled_value(is_getter, value, char, second_char)
+        for lookup, is_list, is_getter, value in get_compiled_filters(filters)[1]
+    )
+
+
+def get_filters_key(filters, char, second_char=None):
+    """Canonical key of the filled filters(lookups and values), usable as a cache key without building them"""
+    return (get_compiled_filters(filters)[0],) + get_filters_values(filters, char, second_char)
+
+
 def get_filters_replaced(filters, char, second_char=None):
     filters_new = {}
-    for filter_k, filter_v in filters.items():
-        if isinstance(filter_v, int) or filter_v is None:
-            filters_new[filter_k] = filter_v
-        elif isinstance(filter_v, (str, unicode)):
-            filters_new[filter_k] = get_value_replaced_second_char(filter_v, char, second_char)
-        elif isinstance(filter_v, list):
-            filters_new[filter_k] = [
-                get_value_replaced_second_char(v, char, second_char)
-                if isinstance(v, (str, unicode)) else v for v in filter_v
-            ]
+    for lookup, is_list, is_getter, value in get_compiled_filters(filters)[1]:
+        if is_list:
+            filters_new[lookup] = [get_compiled_value(is_getter_, v, char, second_char) for is_getter_, v in value]
         else:
-            filters_new[filter_k] = filter_v
+            filters_new[lookup] = get_compiled_value(is_getter, value, char, second_char)
     return filters_new
 
 
@@ -141,7 +325,75 @@ def is_in_time_range(current_seconds, stage_filters):
     return True
 
 
+class RandomStream(random.Random):
+    """
+    Random stream counting the 32 bit words drawn from the Mersenne Twister, (seed, words) is its state:
+    random() takes 2 words, getrandbits(k) ceil(k / 32), the other methods are built on them
+    """
+
+    def __init__(self, seed, words=0):
+        super(RandomStream, self).__init__(seed)
+        self.seed_key = seed
+        self.words = 0
+        if words:
+            self.getrandbits(words * 32)  # skips the drawn words in one call
+
+    def random(self):
+        self.words += 2
+        return super(RandomStream, self).random()
+
+    def getrandbits(self, k):
+        if k > 0:
+            self.words += (k - 1) // 32 + 1
+        return super(RandomStream, self).getrandbits(k)
+
+    def get_state(self):
+        return self.seed_key, self.words
+
+
+def get_random(model_name, pk):
+    """Random stream of the entity derived from the world seed and its id, independent of the calls order"""
+    key = (model_name, pk)
+    stream = random_streams.get(key)
+    if stream is None:
+        stream = RandomStream('{}:{}:{}'.format(world_seed[0], model_name, pk))
+        random_streams[key] = stream
+    return stream
+
+
+def get_random_states():
+    """{(model name, pk): (seed, words)} of the streams, the full generator states are derived on load"""
+    return {k: v.get_state() for k, v in random_streams.items()}
+
+
+def set_random_states(states):
+    for key in [k for k in random_streams if k not in states]:
+        del random_streams[key]
+    for key, state in states.items():
+        stream = random_streams.get(key)
+        if stream is None or stream.get_state() != state:  # streams not drawn since are kept
+            random_streams[key] = RandomStream(*state)
+
+
+def set_world_seed(seed):
+    world_seed[0] = seed
+    random_streams.clear()
+
+
+def to_fixed(value):
+    """Attribute value as an integer number of FIXED_SCALE parts"""
+    return int(round(value * FIXED_SCALE))
+
+
+def from_fixed(value):
+    return value / FIXED_SCALE
+
+
+def fixed_multiply(value, mod):
+    return int(round(value * mod * FIXED_SCALE)) / FIXED_SCALE
+
+
 def dict_multiply(data, time_passed):
     if time_passed == 1:
         return dict(data)
-    return {k: v * 1000 * time_passed / 1000 for k, v in data.items()}
+    return {k: fixed_multiply(v, time_passed) for k, v in data.items()}